@@ -0,0 +1,463 @@
+import asyncio
+import functools
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+import background.content as content
+import background.database as database
+import background.progress_cache as progress_cache
+from background.metrics import REGISTRY
+
+# Total size of the user progress kept in memory, see ProgressCache.
+PROGRESS_CACHE_SIZE = int(os.getenv('PROGRESS_CACHE_SIZE', 500000))
+
+# Database methods that only read data belonging to the user given as their
+# first argument.
+USER_READS = (
+    'player_vocab', 'user_sets', 'total_level', 'total_vocab',
+    'total_times_played', 'total_times_correct', 'set_to_dict', 'user_stats',
+    'dict_page', 'due_vocab', 'next_review', 'user_progress',
+)
+
+# Database methods that read a user's progress, given as their first
+# argument. They are answered by the UserProgress method of the same name.
+CACHED_READS = (
+    'user_exists', 'active_set_id', 'current_level', 'set_is_unlocked',
+    'familiarity', 'familiarities', 'sample_question', 'sample_deck',
+)
+
+# Database methods that only read data shared by every user.
+GLOBAL_READS = (
+    'set_exists', 'as_defn_pair', 'pronunciation', 'native_to_vocab_id',
+    'set_name_to_id', 'max_level', 'catalog', 'guild_prefixes',
+    'shard_commands_since', 'last_shard_command_id', 'catalog_version',
+    'scores', 'top_scores', 'guild_top_scores',
+)
+
+# Database methods that modify data belonging to the user given as their
+# first argument. response_update is handled by the write-behind queue. The
+# progress of the user is read again after each of them.
+USER_WRITES = (
+    'unlock_set', 'check_level_up', 'create_user', 'activate_set',
+)
+
+# Database methods that modify data shared by every user.
+GLOBAL_WRITES = (
+    'set_guild_prefix', 'remove_guild', 'import_guilds', 'post_shard_command',
+    'add_guild_member',
+)
+
+
+class AsyncDatabase():
+    """
+    Awaitable facade over Database that keeps SQLite off the event loop.
+
+    Reads run on a small pool of read-only connections. Writes are serialized
+    through a single writer connection on its own thread, so they never
+    contend with each other. The database is kept in WAL mode, which lets the
+    readers proceed while a write is being committed.
+
+    Writes are group committed. The outcomes of answers are buffered in
+    memory and written together by Database.apply_answers, and the writer
+    transaction is committed every flush_interval seconds or every flush_ops
+    operations, whichever comes first. Reads of a user with uncommitted writes are sent
+    to the writer connection, so a user always sees their own answers.
+    Call flush or close to make everything durable.
+
+    Functions in change_listeners are called with a user id whenever a write
+    for that user is queued, so caches of the user's data can be dropped.
+    Other bot processes may share the database, so functions in
+    external_change_listeners are called without arguments when
+    poll_external_changes finds that another process has committed.
+    Functions in score_listeners are called after every commit that changed
+    the [user_stats] totals of some users, with a dict of those user ids to
+    their committed (total level, times correct).
+
+    The progress of active users is kept in a ProgressCache. Their active
+    set, levels and familiarities are read from memory, and questions are
+    drawn in memory too. Queued answers move the cached familiarities as
+    well, but the writer applies them to the stored familiarity, so a cache
+    that is behind other processes only affects which words are asked.
+    After the other writes to a user, the writer reads that user's progress
+    again in the same job. A progress read that overlaps a write to its user
+    is not cached. Other processes do not say whose data they changed, so
+    their commits empty the cache. The cache never holds the only copy of a
+    change, since every change is also queued for the writer. A user with
+    uncommitted changes who is evicted triggers a commit.
+
+    Every public method of Database is available as a coroutine with the same
+    arguments and return value. The latency of every call, including time
+    spent waiting for a connection, is recorded under the 'query' kind of the
+    metrics registry.
+    """
+
+    def __init__(self, path: str = None, readers: int = 4,
+                 flush_interval: float = 0.05, flush_ops: int = 64):
+        """
+        Arguments:
+            path: location of the SQLite database. Defaults to DB_LOC.
+            readers: number of read-only connections in the pool
+            flush_interval: longest time in seconds a write waits for commit
+            flush_ops: number of queued writes that triggers a commit
+        """
+        # The writer is opened first so the WAL files exist for the readers.
+        self.writer = database.Database(path)
+        self.writer.autocommit = False
+        self._write_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='db-write')
+        self._readers = queue.SimpleQueue()
+        for _ in range(readers):
+            self._readers.put(database.Database(path, read_only=True))
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='db-read')
+        self._num_readers = readers
+
+        self.flush_interval = flush_interval
+        self.flush_ops = flush_ops
+        # (user_id, vocab_id) -> list of whether each queued answer was correct
+        self._answers = {}
+        # users with writes that have not been committed yet
+        self._dirty = set()
+        # user sets of commits that are still running on the writer
+        self._committing = []
+        self._ops = 0
+        self._flush_handle = None
+        self.commits = 0
+        self.change_listeners = []
+        self.external_change_listeners = []
+        self.score_listeners = []
+        self._data_version = None
+        self.progress = progress_cache.ProgressCache(PROGRESS_CACHE_SIZE)
+        # user id -> [progress reads in flight, whether the user changed
+        # while they ran]
+        self._loading = {}
+
+    def _changed(self, user_id: int):
+        self._dirty.add(user_id)
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            loading[1] = True
+        for listener in self.change_listeners:
+            listener(user_id)
+
+    def _is_dirty(self, user_id: int) -> bool:
+        if user_id in self._dirty:
+            return True
+        return any(user_id in users for users in self._committing)
+
+    def _take_answers(self):
+        answers = [key + (outcomes,)
+                   for key, outcomes in self._answers.items()]
+        self._answers = {}
+        return answers
+
+    def _read(self, name: str, *args, **kwargs):
+        db = self._readers.get()
+        try:
+            return getattr(db, name)(*args, **kwargs)
+        finally:
+            self._readers.put(db)
+
+    def _write(self, answers, name: str, *args, **kwargs):
+        if answers:
+            self.writer.apply_answers(answers)
+        if name is None:
+            return None
+        return getattr(self.writer, name)(*args, **kwargs)
+
+    def _begin_load(self, user_id: int):
+        self._loading.setdefault(user_id, [0, False])[0] += 1
+
+    def _end_load(self, user_id: int, progress):
+        loading = self._loading[user_id]
+        loading[0] -= 1
+        if loading[0] == 0:
+            del self._loading[user_id]
+        if loading[1]:
+            self.progress.discard(user_id)
+        elif progress is not None:
+            evicted = self.progress.put(user_id, progress)
+            # write back evicted users right away
+            if any(self._is_dirty(evicted_id) for evicted_id in evicted):
+                asyncio.ensure_future(self.flush())
+
+    def _clear_progress(self):
+        self.progress.clear()
+        for loading in self._loading.values():
+            loading[1] = True
+
+    def _write_progress(self, answers, name: str, user_id: int, *args,
+                        **kwargs):
+        result = self._write(answers, name, user_id, *args, **kwargs)
+        if name == 'check_level_up' and not result[1]:
+            return result, None
+        row = self.writer.user_progress(user_id)
+        if row is None:
+            return result, None
+        return result, progress_cache.UserProgress(*row)
+
+    def _commit(self, answers):
+        self._write(answers, None)
+        changed = self.writer.take_stats_changed()
+        scores = self.writer.scores(changed) if changed else {}
+        self.writer.con.commit()
+        return scores
+
+    def _scores_changed(self, scores):
+        if scores:
+            for listener in self.score_listeners:
+                listener(scores)
+
+    async def run_read(self, name: str, *args, **kwargs):
+        """ Runs a Database method on a read-only connection. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._read_executor,
+            functools.partial(self._read, name, *args, **kwargs))
+
+    async def run_write(self, name: str, *args, **kwargs):
+        """
+        Runs a Database method on the writer connection, after any buffered
+        answers. The change is committed with the next group.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._write_executor,
+            functools.partial(self._write, self._take_answers(), name,
+                              *args, **kwargs))
+
+    async def run_user_read(self, name: str, user_id: int, *args, **kwargs):
+        """
+        Runs a Database method that reads a user's data, on the writer
+        connection if that user has uncommitted writes.
+        """
+        if self._is_dirty(user_id):
+            return await self.run_write(name, user_id, *args, **kwargs)
+        return await self.run_read(name, user_id, *args, **kwargs)
+
+    async def run_cached_read(self, name: str, user_id: int, *args,
+                              **kwargs):
+        """ Runs a Database method that reads a user's progress. """
+        progress = self.progress.get(user_id)
+        if progress is None:
+            progress = await self._load_progress(user_id)
+            if progress is None:  # the Database method handles missing users
+                return await self.run_user_read(name, user_id, *args, **kwargs)
+        return getattr(progress, name)(*args, **kwargs)
+
+    async def _load_progress(self, user_id: int):
+        progress = None
+        self._begin_load(user_id)
+        try:
+            row = await self.run_user_read('user_progress', user_id)
+            if row is not None:
+                progress = progress_cache.UserProgress(*row)
+        finally:
+            self._end_load(user_id, progress)
+        return progress
+
+    async def run_user_write(self, name: str, user_id: int, *args, **kwargs):
+        """
+        Runs a Database method that modifies a user's data, and caches the
+        user's progress after it.
+        """
+        self._changed(user_id)
+        progress = None
+        self._begin_load(user_id)
+        loop = asyncio.get_running_loop()
+        try:
+            result, progress = await loop.run_in_executor(
+                self._write_executor,
+                functools.partial(self._write_progress, self._take_answers(),
+                                  name, user_id, *args, **kwargs))
+            return result
+        finally:
+            self._end_load(user_id, progress)
+            self._queued()
+
+    async def run_global_write(self, name: str, *args, **kwargs):
+        """ Runs a Database method that modifies data shared by every user. """
+        try:
+            return await self.run_write(name, *args, **kwargs)
+        finally:
+            self._queued()
+
+    async def rebuild_user_stats(self, fix: bool = True):
+        """
+        Recomputes [user_stats] and commits the result.
+        See Database.rebuild_user_stats.
+        """
+        with REGISTRY.timer('query', 'rebuild_user_stats'):
+            drift = await self.run_write('rebuild_user_stats', fix)
+            await self.flush()
+        return drift
+
+    async def rebuild_unfamiliar_counts(self, fix: bool = True):
+        """
+        Recomputes the unfamiliar_count of every unlocked set and commits the
+        result. See Database.rebuild_unfamiliar_counts.
+        """
+        with REGISTRY.timer('query', 'rebuild_unfamiliar_counts'):
+            drift = await self.run_write('rebuild_unfamiliar_counts', fix)
+            await self.flush()
+        return drift
+
+    async def update_content(self, path: str, dry_run: bool = False):
+        """
+        Brings the vocab and sets in line with a levels_aux.json file in one
+        transaction on the writer thread. See content.update.
+        """
+        loop = asyncio.get_running_loop()
+        with REGISTRY.timer('query', 'update_content'):
+            await self.flush()
+            scores, changes = await loop.run_in_executor(
+                self._write_executor, self._update_content,
+                self._take_answers(), path, dry_run)
+        self._scores_changed(scores)
+        if changes and not dry_run:
+            self._clear_progress()
+        return changes
+
+    def _update_content(self, answers, path: str, dry_run: bool):
+        # commit writes queued since the flush, so a failed update cannot
+        # roll them back
+        scores = self._commit(answers)
+        return scores, content.update(self.writer, path, dry_run)
+
+    async def response_update(self, user_id: int, vocab_id: int, correct: bool):
+        """ Queues the result of an answer. See Database.response_update. """
+        await self.response_updates(user_id, [(vocab_id, correct)])
+
+    async def response_updates(self, user_id: int, answers):
+        """
+        Queues the results of several answers by one user.
+
+        Only the outcomes are queued. The writer applies them to the stored
+        familiarity when it writes them, see Database.apply_answers.
+
+        Arguments:
+            user_id: Discord user id
+            answers: list of (vocab_id, correct) in the order they were given
+        """
+        progress = self.progress.peek(user_id)
+        for vocab_id, correct in answers:
+            self._answers.setdefault((user_id, vocab_id), []).append(correct)
+            if progress is not None:
+                progress.answered(vocab_id, correct)
+        self._changed(user_id)
+        self._queued(len(answers))
+
+    async def vocab_updates(self, vocab_id: int, results):
+        """
+        Records answers by many users to the same vocab and commits them in
+        one transaction. Users who have not unlocked the vocab are skipped.
+
+        Arguments:
+            vocab_id: vocab that was asked
+            results: dict of user id to whether they answered correctly
+        Returns:
+            List of the user ids that were updated
+        """
+        # read through the writer, which sees every queued unlock
+        with REGISTRY.timer('query', 'vocab_updates'):
+            unlocked = await self.run_write(
+                'vocab_familiarities', vocab_id, list(results))
+        updated = []
+        for user_id, correct in results.items():
+            if user_id not in unlocked:
+                continue
+            self._answers.setdefault((user_id, vocab_id), []).append(correct)
+            progress = self.progress.peek(user_id)
+            if progress is not None:
+                progress.answered(vocab_id, correct)
+            self._changed(user_id)
+            updated.append(user_id)
+        await self.flush()
+        return updated
+
+    async def poll_external_changes(self) -> bool:
+        """
+        Checks whether another process has committed to the database since
+        the last poll, and calls external_change_listeners if it has.
+
+        Returns:
+            bool of whether there were external changes
+        """
+        loop = asyncio.get_running_loop()
+        version = await loop.run_in_executor(
+            self._write_executor, self.writer.data_version)
+        changed = self._data_version is not None and version != self._data_version
+        self._data_version = version
+        if changed:
+            self._clear_progress()
+            for listener in self.external_change_listeners:
+                listener()
+        return changed
+
+    def _queued(self, ops: int = 1):
+        self._ops += ops
+        if self._ops >= self.flush_ops:
+            asyncio.ensure_future(self.flush())
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        """ Writes and commits every queued change. """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._ops = 0
+        users = self._dirty
+        self._dirty = set()
+        self._committing.append(users)
+        loop = asyncio.get_running_loop()
+        try:
+            with REGISTRY.timer('query', 'flush'):
+                scores = await loop.run_in_executor(
+                    self._write_executor, self._commit, self._take_answers())
+            self.commits += 1
+        finally:
+            self._committing.remove(users)
+        self._scores_changed(scores)
+
+    async def close(self):
+        """
+        Commits queued changes, waits for outstanding work to finish and
+        closes every connection.
+        """
+        await self.flush()
+        self._clear_progress()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._close)
+
+    def _close(self):
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        self.writer.close()
+        for _ in range(self._num_readers):
+            self._readers.get().close()
+
+
+def _make_method(name: str, runner: str):
+    target = getattr(database.Database, name)
+
+    @functools.wraps(target)
+    async def method(self, *args, **kwargs):
+        with REGISTRY.timer('query', name):
+            return await getattr(self, runner)(name, *args, **kwargs)
+    return method
+
+
+for _name in USER_READS:
+    setattr(AsyncDatabase, _name, _make_method(_name, 'run_user_read'))
+for _name in CACHED_READS:
+    setattr(AsyncDatabase, _name, _make_method(_name, 'run_cached_read'))
+for _name in GLOBAL_READS:
+    setattr(AsyncDatabase, _name, _make_method(_name, 'run_read'))
+for _name in USER_WRITES:
+    setattr(AsyncDatabase, _name, _make_method(_name, 'run_user_write'))
+for _name in GLOBAL_WRITES:
+    setattr(AsyncDatabase, _name, _make_method(_name, 'run_global_write'))
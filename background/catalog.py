@@ -0,0 +1,161 @@
+import os
+import pickle
+
+
+class VocabCatalog():
+    """
+    Immutable in-memory copy of the vocab, sets and set-to-vocab tables.
+
+    Vocab fields are stored in tuples indexed by vocab_id, so a lookup is a
+    single index operation. A catalog is never modified after it is built;
+    to pick up new data, load a new catalog and replace the reference to the
+    old one.
+    """
+
+    __slots__ = ('char_native', 'romanization', 'pronunciations', 'native_ids',
+                 'set_names', 'set_ids', 'total_levels', 'unlock_descs',
+                 'set_levels')
+
+    def __init__(self, vocab_rows, set_rows, set_vocab_rows):
+        """
+        Arguments:
+            vocab_rows: (vocab_id, char_native, romanization, pronunciation)
+                rows of the vocab table
+            set_rows: (set_id, name, total_levels, unlock_desc) rows of the
+                sets table
+            set_vocab_rows: (set_id, vocab_id, level) rows of the
+                set-to-vocab table
+        """
+        vocab_rows = list(vocab_rows)
+        size = max((row[0] for row in vocab_rows), default=-1) + 1
+        char_native = [None] * size
+        romanization = [None] * size
+        pronunciations = [None] * size
+        native_ids = {}
+        for vocab_id, native, romaji, pronunciation in vocab_rows:
+            char_native[vocab_id] = native
+            romanization[vocab_id] = romaji
+            pronunciations[vocab_id] = pronunciation
+            native_ids[native] = vocab_id
+        self.char_native = tuple(char_native)
+        self.romanization = tuple(romanization)
+        self.pronunciations = tuple(pronunciations)
+        self.native_ids = native_ids
+
+        self.set_names = {}
+        self.set_ids = {}
+        self.total_levels = {}
+        self.unlock_descs = {}
+        for set_id, name, total_levels, unlock_desc in set_rows:
+            self.set_names[set_id] = name
+            self.set_ids[name.casefold()] = set_id
+            self.total_levels[set_id] = total_levels
+            self.unlock_descs[set_id] = unlock_desc
+
+        levels = {}
+        for set_id, vocab_id, level in set_vocab_rows:
+            levels.setdefault((set_id, level), []).append(vocab_id)
+        self.set_levels = {key: tuple(ids) for key, ids in levels.items()}
+
+    @classmethod
+    def load(cls, cur):
+        """
+        Builds a catalog from the database.
+
+        Arguments:
+            cur: cursor of an open database connection
+        """
+        cur.execute("SELECT vocab_id, char_native, romanization, pronunciation \
+            FROM 'vocab'")
+        vocab_rows = cur.fetchall()
+        cur.execute("SELECT set_id, name, total_levels, unlock_desc FROM 'sets'")
+        set_rows = cur.fetchall()
+        cur.execute("SELECT set_id, vocab_id, level FROM 'set-to-vocab'")
+        set_vocab_rows = cur.fetchall()
+        return cls(vocab_rows, set_rows, set_vocab_rows)
+
+    @classmethod
+    def load_snapshot(cls, cur, path: str, version: int):
+        """
+        Returns the catalog saved in a snapshot file if it was built from the
+        current catalog version. Otherwise the catalog is built from the
+        database and saved as the new snapshot.
+
+        Unpickling a snapshot is much cheaper than rebuilding the catalog, so
+        the bot starts faster when the vocab has not changed.
+
+        Arguments:
+            cur: cursor of an open database connection
+            path: location of the snapshot file
+            version: catalog version of the database, read before this call
+        """
+        try:
+            with open(path, 'rb') as f:
+                snapshot_version, catalog = pickle.load(f)
+            if snapshot_version == version and isinstance(catalog, cls):
+                return catalog
+        except Exception:
+            pass  # missing, corrupt or written by an older version of the bot
+        catalog = cls.load(cur)
+        catalog.save_snapshot(path, version)
+        return catalog
+
+    def save_snapshot(self, path: str, version: int):
+        """
+        Atomically writes the catalog to a snapshot file. Failing to write is
+        not an error, as the snapshot only speeds up the next start.
+        """
+        # several bot processes may save the same snapshot at once
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((version, self), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def as_defn_pair(self, vocab_id: int):
+        """
+        Returns a pair of the native character and its romanization
+
+        Raises:
+            IndexError if the vocab id does not exist
+        """
+        return self.char_native[vocab_id], self.romanization[vocab_id]
+
+    def pronunciation(self, vocab_id: int):
+        """
+        Returns a string with the pronunciation of vocab_id, or None if it
+        has none.
+        """
+        return self.pronunciations[vocab_id]
+
+    def native_to_vocab_id(self, native_char: str) -> int:
+        """
+        Returns the vocabulary id of a native character.
+
+        Raises:
+            KeyError if the character is not in the catalog
+        """
+        return self.native_ids[native_char]
+
+    def set_exists(self, set_id: int) -> bool:
+        """ Returns a bool of whether the set exists. """
+        return set_id in self.set_names
+
+    def set_name_to_id(self, name: str) -> int:
+        """
+        Returns the set id of a set name, ignoring case.
+
+        Raises:
+            KeyError if no set has this name
+        """
+        return self.set_ids[name.strip().casefold()]
+
+    def max_level(self, set_id: int) -> int:
+        """ Returns the maximum level of the given set. """
+        return self.total_levels[set_id]
+
+    def level_vocab(self, set_id: int, level: int):
+        """ Returns a tuple of the vocab ids in a level of a set. """
+        return self.set_levels.get((set_id, level), ())
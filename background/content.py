@@ -0,0 +1,392 @@
+"""
+Builds the vocab and set tables of the database from levels_aux.json.
+
+levels_aux.json maps each set name to an object holding the set's total_lvls,
+an optional unlock_desc and one object per level, keyed by the level number,
+that maps native characters to their romanization.
+
+The file is parsed incrementally, one level at a time, and compared with the
+database. Only the rows that differ are written, all in one transaction.
+Pronunciations and definitions already in the database are kept. Vocab
+removed from a set stays in the vocab table so users keep their progress on
+it, and users who already passed the level of newly added vocab get it
+unlocked.
+
+Usage:
+    python -m background.content data/levels_aux.json --dry-run
+    python -m background.content data/levels_aux.json
+"""
+import argparse
+import json
+
+import background.database as database
+
+CHUNK_SIZE = 1 << 16
+
+
+class _JSONStream():
+    """
+    Reads the members of nested JSON objects from a file without decoding the
+    whole document. Values are decoded one at a time, so memory use is bound
+    by the largest value read rather than the file.
+    """
+
+    def __init__(self, f, chunk_size: int = CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def _peek(self) -> str:
+        """ Returns the next character that is not whitespace. """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of JSON')
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f'Expected {char!r} at character {self.pos} '
+                             f'of the current chunk')
+        self.pos += 1
+
+    def value(self):
+        """ Decodes the next JSON value. """
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def members(self):
+        """
+        Yields the keys of the next JSON object. The caller must read or
+        iterate the value of each key before asking for the next one.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f'Expected an object key, got {key!r}')
+            self._expect(':')
+            yield key
+            separator = self._peek()
+            self.pos += 1
+            if separator == '}':
+                return
+            if separator != ',':
+                raise ValueError(f'Expected , or }} after {key!r}')
+
+
+class Content():
+    """
+    Sets and vocab described by a levels_aux.json file.
+
+    Attributes:
+        sets: dict of set name to [total levels, unlock description]
+        vocab: dict of native character to romanization
+        placements: dict of (set name, native character) to level
+    """
+
+    def __init__(self):
+        self.sets = {}
+        self.vocab = {}
+        self.placements = {}
+
+    @classmethod
+    def read(cls, path: str):
+        """
+        Parses a levels_aux.json file one level at a time.
+
+        Raises:
+            ValueError if the file is malformed or contradicts itself
+        """
+        content = cls()
+        with open(path, 'r', encoding='utf-8') as f:
+            stream = _JSONStream(f)
+            for set_name in stream.members():
+                content.sets[set_name] = [None, None]
+                for key in stream.members():
+                    if key == 'total_lvls':
+                        content.sets[set_name][0] = int(stream.value())
+                    elif key == 'unlock_desc':
+                        content.sets[set_name][1] = stream.value()
+                    elif key.isdigit():
+                        content._add_level(set_name, int(key), stream)
+                    else:
+                        stream.value()  # unknown keys are ignored
+                content._check_set(set_name)
+        return content
+
+    def _add_level(self, set_name: str, level: int, stream: _JSONStream):
+        for native in stream.members():
+            romaji = stream.value()
+            if not isinstance(romaji, str):
+                raise ValueError(f'Expected the romanization of {native} in '
+                                 f'level {level} of {set_name}, got {romaji!r}')
+            if self.vocab.setdefault(native, romaji) != romaji:
+                raise ValueError(f'{native} is romanized as both '
+                                 f'{self.vocab[native]} and {romaji}')
+            if (set_name, native) in self.placements:
+                raise ValueError(f'{native} is in more than one level of '
+                                 f'{set_name}')
+            self.placements[(set_name, native)] = level
+
+    def _check_set(self, set_name: str):
+        total_levels = self.sets[set_name][0]
+        if total_levels == None:
+            raise ValueError(f'{set_name} has no total_lvls')
+        for (name, native), level in self.placements.items():
+            if name == set_name and not 1 <= level <= total_levels:
+                raise ValueError(f'{native} is in level {level} of {set_name}, '
+                                 f'which only has {total_levels} levels')
+
+
+class ContentChanges():
+    """ Differences between a Content and the database. """
+
+    def __init__(self):
+        # (name, total_levels, unlock_desc)
+        self.new_sets = []
+        # (set_id, name, total_levels, unlock_desc)
+        self.changed_sets = []
+        # (native, romaji)
+        self.new_vocab = []
+        # (vocab_id, native, old romaji, new romaji)
+        self.changed_vocab = []
+        # (set name, native, level)
+        self.added = []
+        # (set_id, vocab_id, native, old level, new level)
+        self.moved = []
+        # (set_id, vocab_id, native, level)
+        self.removed = []
+        self.unlocked = 0
+
+    def __bool__(self):
+        return bool(self.new_sets or self.changed_sets or self.new_vocab or
+                    self.changed_vocab or self.added or self.moved or
+                    self.removed)
+
+    def report(self, examples: int = 5):
+        """
+        Returns a list of lines describing the changes, with up to the given
+        number of examples of each kind.
+        """
+        sections = (
+            ('sets added', [name for name, _, _ in self.new_sets]),
+            ('sets changed', [name for _, name, _, _ in self.changed_sets]),
+            ('vocab added', [f'{native} {romaji}'
+                             for native, romaji in self.new_vocab]),
+            ('romanizations changed', [f'{native} {old} → {new}'
+                                       for _, native, old, new in self.changed_vocab]),
+            ('vocab added to sets', [f'{native} (level {level})'
+                                     for _, native, level in self.added]),
+            ('vocab moved', [f'{native} (level {old} → {new})'
+                             for _, _, native, old, new in self.moved]),
+            ('vocab removed from sets', [f'{native} (level {level})'
+                                         for _, _, native, level in self.removed]),
+        )
+        lines = []
+        for title, entries in sections:
+            if not entries:
+                continue
+            shown = ', '.join(entries[:examples])
+            more = f' and {len(entries) - examples} more' \
+                if len(entries) > examples else ''
+            lines.append(f'{len(entries)} {title}: {shown}{more}')
+        if self.unlocked:
+            lines.append(f'{self.unlocked} vocab unlocked for existing users')
+        return lines or ['No changes.']
+
+
+def diff(cur, content: Content) -> ContentChanges:
+    """ Compares a Content with the vocab and set tables of the database. """
+    changes = ContentChanges()
+
+    # set names are matched ignoring case, like Database.set_name_to_id
+    names = {name.casefold(): name for name in content.sets}
+
+    cur.execute("SELECT set_id, name, total_levels, unlock_desc FROM 'sets'")
+    set_ids = {}
+    for set_id, name, total_levels, unlock_desc in cur.fetchall():
+        set_ids[name.casefold()] = set_id
+        wanted = content.sets.get(names.get(name.casefold()))
+        if wanted == None:
+            continue
+        # a missing unlock_desc in the file keeps the one in the database
+        wanted_desc = unlock_desc if wanted[1] == None else wanted[1]
+        if (total_levels, unlock_desc) != (wanted[0], wanted_desc):
+            changes.changed_sets.append((set_id, name, wanted[0], wanted_desc))
+    for name, (total_levels, unlock_desc) in content.sets.items():
+        if name.casefold() not in set_ids:
+            changes.new_sets.append((name, total_levels, unlock_desc))
+
+    cur.execute("SELECT vocab_id, char_native, romanization FROM 'vocab'")
+    vocab_ids = {}
+    for vocab_id, native, romaji in cur.fetchall():
+        vocab_ids[native] = vocab_id
+        wanted = content.vocab.get(native)
+        if wanted != None and wanted != romaji:
+            changes.changed_vocab.append((vocab_id, native, romaji, wanted))
+    for native, romaji in content.vocab.items():
+        if native not in vocab_ids:
+            changes.new_vocab.append((native, romaji))
+
+    cur.execute("SELECT sv.set_id, s.name, sv.vocab_id, v.char_native, sv.level \
+        FROM 'set-to-vocab' AS sv INNER JOIN 'sets' AS s USING (set_id) \
+        INNER JOIN 'vocab' AS v USING (vocab_id)")
+    placed = set()
+    for set_id, set_name, vocab_id, native, level in cur.fetchall():
+        set_name = names.get(set_name.casefold())
+        if set_name == None:
+            continue  # sets missing from the file are left alone
+        placed.add((set_name, native))
+        wanted = content.placements.get((set_name, native))
+        if wanted == None:
+            changes.removed.append((set_id, vocab_id, native, level))
+        elif wanted != level:
+            changes.moved.append((set_id, vocab_id, native, level, wanted))
+    for (set_name, native), level in content.placements.items():
+        if (set_name, native) not in placed:
+            changes.added.append((set_name, native, level))
+    return changes
+
+
+def apply(db: database.Database, changes: ContentChanges):
+    """
+    Writes changes to the database in a single transaction, and unlocks new
+    vocab for users who are already past its level.
+
+    Arguments:
+        db: Database with a writer connection and no uncommitted changes
+        changes: result of diff against the same database
+    """
+    cur = db.cur
+    try:
+        cur.execute("SELECT set_id, name FROM 'sets'")
+        set_ids = {name.casefold(): set_id for set_id, name in cur.fetchall()}
+        for name, total_levels, unlock_desc in changes.new_sets:
+            cur.execute("INSERT INTO 'sets' (name, total_levels, unlock_desc) \
+                VALUES (?, ?, ?)", [name, total_levels, unlock_desc])
+            set_ids[name.casefold()] = cur.lastrowid
+        cur.executemany("UPDATE 'sets' SET total_levels = ?, unlock_desc = ? \
+            WHERE set_id = ?", [(total_levels, unlock_desc, set_id)
+                                for set_id, _, total_levels, unlock_desc
+                                in changes.changed_sets])
+
+        vocab_ids = {}
+        for native, romaji in changes.new_vocab:
+            cur.execute("INSERT INTO 'vocab' (char_native, romanization) \
+                VALUES (?, ?)", [native, romaji])
+            vocab_ids[native] = cur.lastrowid
+        cur.executemany("UPDATE 'vocab' SET romanization = ? WHERE vocab_id = ?",
+                        [(new, vocab_id) for vocab_id, _, _, new
+                         in changes.changed_vocab])
+
+        placements = []
+        for set_name, native, level in changes.added:
+            vocab_id = vocab_ids.get(native)
+            if vocab_id == None:
+                cur.execute("SELECT vocab_id FROM 'vocab' WHERE char_native = ?",
+                            [native])
+                vocab_id = cur.fetchone()[0]
+            placements.append((set_ids[set_name.casefold()], vocab_id, level))
+        cur.executemany("INSERT INTO 'set-to-vocab' (set_id, vocab_id, level) \
+            VALUES (?, ?, ?)", placements)
+        cur.executemany("UPDATE 'set-to-vocab' SET level = ? \
+            WHERE set_id = ? AND vocab_id = ?",
+                        [(new, set_id, vocab_id) for set_id, vocab_id, _, _, new
+                         in changes.moved])
+        cur.executemany("DELETE FROM 'set-to-vocab' \
+            WHERE set_id = ? AND vocab_id = ?",
+                        [(set_id, vocab_id) for set_id, vocab_id, _, _
+                         in changes.removed])
+
+        # users past the level of added or moved vocab would never unlock it
+        unlock = placements + [(set_id, vocab_id, new) for set_id, vocab_id,
+                               _, _, new in changes.moved]
+        changes.unlocked = 0
+        for set_id, vocab_id, level in unlock:
+            cur.execute("INSERT INTO 'user-to-vocab' (user_id, vocab_id, \
+                times_correct, times_shown, familiarity) \
+                SELECT us.user_id, ?, 0, 0, 0 FROM 'unlocked-sets' AS us \
+                WHERE us.set_id = ? AND us.current_level >= ? \
+                AND NOT EXISTS (SELECT * FROM 'user-to-vocab' AS uv \
+                WHERE uv.user_id = us.user_id AND uv.vocab_id = ?)",
+                        [vocab_id, set_id, level, vocab_id])
+            changes.unlocked += cur.rowcount
+
+        affected = {set_id for set_id, _, _ in unlock} | \
+            {set_id for set_id, _, _, _ in changes.removed}
+        for set_id in affected:
+            db.refresh_set_counts(set_id)
+        db.con.commit()
+    except:
+        db.con.rollback()
+        raise
+
+
+def update(db: database.Database, path: str, dry_run: bool = False):
+    """
+    Brings the database in line with a levels_aux.json file.
+
+    Arguments:
+        db: Database with a writer connection and no uncommitted changes
+        path: location of levels_aux.json
+        dry_run: only compute the changes, without writing them
+    Returns:
+        ContentChanges that were, or with dry_run would be, applied
+    Raises:
+        ValueError if the file is malformed
+    """
+    changes = diff(db.cur, Content.read(path))
+    if changes and not dry_run:
+        apply(db, changes)
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', nargs='?', default='data/levels_aux.json')
+    parser.add_argument('--db', help='database to update, DB_LOC by default')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='show the changes without writing them')
+    args = parser.parse_args()
+
+    db = database.Database(args.db)
+    try:
+        changes = update(db, args.path, args.dry_run)
+    finally:
+        db.close()
+    for line in changes.report():
+        print(line)
+    if args.dry_run and changes:
+        print('Dry run, nothing was written.')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,398 @@
 import sqlite3
-import numpy as np
+import random
+import time
+import background.catalog as catalog
 
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 DB_LOC = os.getenv('DB_LOC')
+# Seconds a connection waits for another process to release a lock on the
+# database before giving up.
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 10))
+
+# Vocab ids of a user's active set up to their current level in that set.
+# Expects the user id as its only parameter.
+ACTIVE_VOCAB = "SELECT sv.vocab_id FROM 'set-to-vocab' AS sv \
+    INNER JOIN 'users' AS u ON sv.set_id = u.active_set_id \
+    INNER JOIN 'unlocked-sets' AS us \
+    ON us.user_id = u.user_id AND us.set_id = sv.set_id \
+    WHERE u.user_id = ? AND sv.level <= us.current_level"
+
+# Profile totals of every user recomputed from the raw tables, as
+# (user_id, total_level, times_correct, times_shown, vocab_count) rows.
+USER_STATS_QUERY = "SELECT u.user_id, \
+    (SELECT IFNULL(SUM(current_level), 0) FROM 'unlocked-sets' \
+        WHERE user_id = u.user_id), \
+    IFNULL(SUM(uv.times_correct), 0), IFNULL(SUM(uv.times_shown), 0), \
+    COUNT(uv.vocab_id) \
+    FROM 'users' AS u LEFT JOIN 'user-to-vocab' AS uv USING (user_id) \
+    GROUP BY u.user_id"
+
+
+def draw_deck(rows, bin_weights, size: int):
+    """
+    Draws words from rows grouped into familiarity bins.
+
+    Every draw chooses a non-empty bin with probability proportional to its
+    weight and a word uniformly from that bin. Words are not repeated until
+    every word has been drawn.
+
+    Arguments:
+        rows: (familiarity, vocab_id, native character, romanization) rows
+        bin_weights: sequence of 10 weights, one per familiarity level
+        size: number of words to draw
+    Returns:
+        List of (vocab_id, native character, romanization) triples
+    """
+    rows = [row for row in rows if bin_weights[row[0]] > 0]
+    deck = []
+    bins = {}
+    while len(deck) < size and rows:
+        if not bins:
+            for row in rows:
+                bins.setdefault(row[0], []).append(row[1:])
+        levels = list(bins)
+        weights = [bin_weights[level] for level in levels]
+        familiarity = random.choices(levels, weights=weights)[0]
+        words = bins[familiarity]
+        deck.append(words.pop(random.randrange(len(words))))
+        if not words:
+            del bins[familiarity]
+    return deck
+
+
+def _execute_script(cur, script: str):
+    """
+    Runs statements separated by semicolons one at a time. Unlike
+    executescript, this does not commit the open transaction.
+    """
+    for statement in script.split(';'):
+        if statement.strip():
+            cur.execute(statement)
+
+
+def _migration_base_schema(cur):
+    """ Creates the original tables of the bot. """
+    _execute_script(cur, """
+        CREATE TABLE IF NOT EXISTS 'users' (
+            user_id INTEGER PRIMARY KEY,
+            active_set_id INTEGER NOT NULL DEFAULT 1);
+        CREATE TABLE IF NOT EXISTS 'sets' (
+            set_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            total_levels INTEGER NOT NULL,
+            unlock_desc TEXT);
+        CREATE TABLE IF NOT EXISTS 'vocab' (
+            vocab_id INTEGER PRIMARY KEY,
+            char_native TEXT NOT NULL,
+            romanization TEXT NOT NULL,
+            definition TEXT,
+            pronunciation TEXT);
+        CREATE TABLE IF NOT EXISTS 'set-to-vocab' (
+            set_id INTEGER NOT NULL,
+            vocab_id INTEGER NOT NULL,
+            level INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS 'unlocked-sets' (
+            user_id INTEGER NOT NULL,
+            set_id INTEGER NOT NULL,
+            current_level INTEGER NOT NULL DEFAULT 1);
+        CREATE TABLE IF NOT EXISTS 'user-to-vocab' (
+            user_id INTEGER NOT NULL,
+            vocab_id INTEGER NOT NULL,
+            times_correct INTEGER NOT NULL DEFAULT 0,
+            times_shown INTEGER NOT NULL DEFAULT 0,
+            familiarity INTEGER NOT NULL DEFAULT 0,
+            last_asked INTEGER);
+    """)
+
+
+def _migration_unfamiliar_count(cur):
+    """
+    Adds the unfamiliar_count column of [unlocked-sets], which counts the
+    user's unlocked vocab in the set that is below familiarity 5.
+    """
+    cur.execute("PRAGMA table_info('unlocked-sets')")
+    if any(column[1] == 'unfamiliar_count' for column in cur.fetchall()):
+        return
+    cur.execute("ALTER TABLE 'unlocked-sets' \
+        ADD COLUMN unfamiliar_count INTEGER NOT NULL DEFAULT 0")
+    cur.execute("UPDATE 'unlocked-sets' SET unfamiliar_count = ( \
+        SELECT COUNT(*) FROM 'user-to-vocab' AS uv \
+        INNER JOIN 'set-to-vocab' AS sv USING (vocab_id) \
+        WHERE uv.user_id = 'unlocked-sets'.user_id \
+        AND sv.set_id = 'unlocked-sets'.set_id AND uv.familiarity < 5)")
+
+
+def _migration_user_stats(cur):
+    """ Adds the [user_stats] table of profile totals per user. """
+    cur.execute("SELECT name FROM sqlite_master \
+        WHERE type = 'table' AND name = 'user_stats'")
+    if cur.fetchone() != None:
+        return
+    cur.execute("CREATE TABLE 'user_stats' ( \
+        user_id INTEGER PRIMARY KEY, \
+        total_level INTEGER NOT NULL DEFAULT 0, \
+        times_correct INTEGER NOT NULL DEFAULT 0, \
+        times_shown INTEGER NOT NULL DEFAULT 0, \
+        vocab_count INTEGER NOT NULL DEFAULT 0)")
+    cur.execute(f"INSERT INTO 'user_stats' (user_id, total_level, \
+        times_correct, times_shown, vocab_count) {USER_STATS_QUERY}")
+
+
+def _migration_indexes(cur):
+    """ Adds indexes matching the access patterns of Database. """
+    _execute_script(cur, """
+        CREATE INDEX IF NOT EXISTS 'user-to-vocab_user_vocab'
+            ON 'user-to-vocab' (user_id, vocab_id);
+        CREATE INDEX IF NOT EXISTS 'user-to-vocab_user_familiarity'
+            ON 'user-to-vocab' (user_id, familiarity);
+        CREATE INDEX IF NOT EXISTS 'set-to-vocab_set_level'
+            ON 'set-to-vocab' (set_id, level);
+        CREATE INDEX IF NOT EXISTS 'set-to-vocab_vocab'
+            ON 'set-to-vocab' (vocab_id);
+        CREATE INDEX IF NOT EXISTS 'unlocked-sets_user_set'
+            ON 'unlocked-sets' (user_id, set_id);
+        CREATE INDEX IF NOT EXISTS 'vocab_native'
+            ON 'vocab' (char_native);
+        CREATE INDEX IF NOT EXISTS 'sets_name'
+            ON 'sets' (name COLLATE NOCASE);
+    """)
+
+
+def _migration_guilds(cur):
+    """ Adds the [guilds] table of per-guild settings. """
+    cur.execute("CREATE TABLE IF NOT EXISTS 'guilds' ( \
+        guild_id INTEGER PRIMARY KEY, \
+        prefix TEXT NOT NULL)")
+
+
+def _migration_shard_commands(cur):
+    """
+    Adds the [shard_commands] table, through which the owner commands of
+    one bot process reach every other process.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS 'shard_commands' ( \
+        command_id INTEGER PRIMARY KEY, \
+        command TEXT NOT NULL, \
+        argument TEXT, \
+        origin TEXT NOT NULL)")
+
+
+# Tables copied into VocabCatalog. Any change to them bumps the catalog
+# version, which tells catalog snapshots apart.
+CATALOG_TABLES = ('vocab', 'sets', 'set-to-vocab')
+
+
+def _migration_catalog_version(cur):
+    """
+    Adds the [catalog_version] table and the triggers that bump its version
+    whenever a table of the catalog changes.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS 'catalog_version' ( \
+        version INTEGER NOT NULL)")
+    cur.execute("INSERT INTO 'catalog_version' (version) SELECT 0 \
+        WHERE NOT EXISTS (SELECT * FROM 'catalog_version')")
+    for table in CATALOG_TABLES:
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS \
+                '{table}_{event.lower()}_catalog_version' \
+                AFTER {event} ON '{table}' BEGIN \
+                UPDATE 'catalog_version' SET version = version + 1; END")
+
+
+def _migration_next_due(cur):
+    """
+    Adds the next_due column of [user-to-vocab], the unix time at which the
+    vocab is due for review. Vocab that has never been scheduled is due
+    immediately.
+    """
+    cur.execute("PRAGMA table_info('user-to-vocab')")
+    if not any(column[1] == 'next_due' for column in cur.fetchall()):
+        cur.execute("ALTER TABLE 'user-to-vocab' \
+            ADD COLUMN next_due INTEGER NOT NULL DEFAULT 0")
+    cur.execute("CREATE INDEX IF NOT EXISTS 'user-to-vocab_user_due' \
+        ON 'user-to-vocab' (user_id, next_due)")
+
+
+def _migration_leaderboard(cur):
+    """
+    Adds an index of [user_stats] in leaderboard order and the
+    [guild_members] table of the guilds each user has played in.
+    """
+    cur.execute("CREATE INDEX IF NOT EXISTS 'user_stats_score' \
+        ON 'user_stats' (total_level DESC, times_correct DESC)")
+    cur.execute("CREATE TABLE IF NOT EXISTS 'guild_members' ( \
+        guild_id INTEGER NOT NULL, \
+        user_id INTEGER NOT NULL, \
+        PRIMARY KEY (guild_id, user_id)) WITHOUT ROWID")
+
+
+def _migration_unique_pairs(cur):
+    """
+    Removes duplicate [unlocked-sets] and [user-to-vocab] rows, which
+    overlapping unlocks could insert, and makes the (user_id, set_id) and
+    (user_id, vocab_id) indexes unique so they cannot come back. The counts
+    derived from these tables are recomputed if any row was removed.
+    """
+    # keep the highest level of a set, and the oldest row of a vocab, whose
+    # counters every update already shared with its duplicates
+    cur.execute("DELETE FROM 'unlocked-sets' WHERE EXISTS ( \
+        SELECT * FROM 'unlocked-sets' AS us \
+        WHERE us.user_id = 'unlocked-sets'.user_id \
+        AND us.set_id = 'unlocked-sets'.set_id \
+        AND (us.current_level > 'unlocked-sets'.current_level \
+        OR (us.current_level = 'unlocked-sets'.current_level \
+        AND us.rowid < 'unlocked-sets'.rowid)))")
+    removed = cur.rowcount
+    cur.execute("DELETE FROM 'user-to-vocab' WHERE EXISTS ( \
+        SELECT * FROM 'user-to-vocab' AS uv \
+        WHERE uv.user_id = 'user-to-vocab'.user_id \
+        AND uv.vocab_id = 'user-to-vocab'.vocab_id \
+        AND uv.rowid < 'user-to-vocab'.rowid)")
+    removed += cur.rowcount
+    _execute_script(cur, """
+        DROP INDEX IF EXISTS 'unlocked-sets_user_set';
+        CREATE UNIQUE INDEX 'unlocked-sets_user_set'
+            ON 'unlocked-sets' (user_id, set_id);
+        DROP INDEX IF EXISTS 'user-to-vocab_user_vocab';
+        CREATE UNIQUE INDEX 'user-to-vocab_user_vocab'
+            ON 'user-to-vocab' (user_id, vocab_id);
+    """)
+    if removed == 0:
+        return
+    cur.execute("UPDATE 'unlocked-sets' SET unfamiliar_count = ( \
+        SELECT COUNT(*) FROM 'user-to-vocab' AS uv \
+        INNER JOIN 'set-to-vocab' AS sv USING (vocab_id) \
+        WHERE uv.user_id = 'unlocked-sets'.user_id \
+        AND sv.set_id = 'unlocked-sets'.set_id AND uv.familiarity < 5)")
+    cur.execute("DELETE FROM 'user_stats'")
+    cur.execute(f"INSERT INTO 'user_stats' (user_id, total_level, \
+        times_correct, times_shown, vocab_count) {USER_STATS_QUERY}")
+
+
+# Schema migrations in the order they are applied. The number of migrations
+# applied to a database is stored in its user_version pragma, so new
+# migrations must only ever be appended.
+MIGRATIONS = (
+    _migration_base_schema,
+    _migration_unfamiliar_count,
+    _migration_user_stats,
+    _migration_indexes,
+    _migration_guilds,
+    _migration_shard_commands,
+    _migration_catalog_version,
+    _migration_next_due,
+    _migration_leaderboard,
+    _migration_unique_pairs,
+)
+
+# Seconds until a vocab is due for review again, by its familiarity after
+# the answer. Wrong answers lower the familiarity and so shorten the wait.
+REVIEW_INTERVALS = (
+    60, 5 * 60, 30 * 60, 2 * 3600, 8 * 3600,
+    86400, 3 * 86400, 7 * 86400, 14 * 86400, 30 * 86400,
+)
+
+
+def migrate(con):
+    """
+    Applies every migration the database has not seen yet. Each migration is
+    committed together with the new schema version.
+
+    The schema version is read inside a write transaction, so processes
+    starting at the same time apply each migration exactly once.
+
+    Arguments:
+        con: open sqlite3 connection
+    Returns:
+        int of the schema version after migrating
+    """
+    cur = con.cursor()
+    while True:
+        cur.execute('BEGIN IMMEDIATE')
+        version = cur.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            con.commit()
+            return version
+        MIGRATIONS[version](cur)
+        cur.execute(f'PRAGMA user_version = {version + 1}')
+        con.commit()
 
 
 class Database():
-    def __init__(self):
-        self.con = sqlite3.connect(DB_LOC)
+    def __init__(self, path: str = None, read_only: bool = False):
+        """
+        Arguments:
+            path: location of the SQLite database. Defaults to DB_LOC.
+            read_only: open the connection in read-only mode. Read-only
+                connections may be shared between threads.
+        """
+        if path == None:
+            path = DB_LOC
+        if read_only:
+            self.con = sqlite3.connect(
+                f'file:{path}?mode=ro', uri=True, timeout=DB_BUSY_TIMEOUT,
+                check_same_thread=False)
+        else:
+            # Several bot processes may write to the same database. Taking
+            # the write lock when a transaction begins, rather than on its
+            # first write, makes a writer wait its turn instead of failing
+            # to upgrade a read it started before another process committed.
+            self.con = sqlite3.connect(
+                path, timeout=DB_BUSY_TIMEOUT, isolation_level='IMMEDIATE',
+                check_same_thread=False)
+            self.con.execute('PRAGMA journal_mode=WAL')
+            self.con.execute('PRAGMA synchronous=NORMAL')
         self.cur = self.con.cursor()
+        # When False, write methods leave their changes in the open
+        # transaction and the owner of the connection commits them in groups.
+        self.autocommit = True
+        # users whose [user_stats] totals changed in the open transaction,
+        # tracked while autocommit is off. See take_stats_changed.
+        self.stats_changed = set()
+        if not read_only:
+            migrate(self.con)
         print('Connected to database.')
 
+    def __commit(self):
+        if self.autocommit:
+            self.con.commit()
+
+    def close(self):
+        """ Commits any outstanding changes and closes the connection. """
+        self.con.commit()
+        self.con.close()
+
+    def __bump_stats(self, rows):
+        """
+        Adds to the [user_stats] totals of users, creating rows as needed.
+
+        Arguments:
+            rows: list of (user_id, level delta, times correct delta,
+                times shown delta, vocab count delta)
+        """
+        self.cur.executemany(
+            "INSERT INTO 'user_stats' \
+            (user_id, total_level, times_correct, times_shown, vocab_count) \
+            VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET \
+            total_level = total_level + excluded.total_level, \
+            times_correct = times_correct + excluded.times_correct, \
+            times_shown = times_shown + excluded.times_shown, \
+            vocab_count = vocab_count + excluded.vocab_count", rows)
+        if not self.autocommit:
+            self.stats_changed.update(row[0] for row in rows)
+
+    def take_stats_changed(self):
+        """
+        Returns the set of users whose [user_stats] totals were changed by
+        this connection since the last call, and starts a new set.
+        """
+        changed = self.stats_changed
+        self.stats_changed = set()
+        return changed
+
     def user_exists(self, user_id: int):
         """
         Returns a bool of whether the user exists in the database.
@@ -85,6 +464,35 @@ class Database():
             raise RuntimeError(
                 f'Cannot find {vocab_id} for user {user_id}')
 
+    def familiarities(self, user_id: int, vocab_ids):
+        """
+        Returns a dict of vocab id to the user's familiarity for several vocab.
+
+        Raises:
+            RuntimeError if any user_id, vocab_id pair is invalid
+        """
+        vocab_ids = list(vocab_ids)
+        marks = ', '.join('?' * len(vocab_ids))
+        self.cur.execute(f"SELECT vocab_id, familiarity FROM 'user-to-vocab' \
+            WHERE user_id = ? AND vocab_id IN ({marks})", [user_id] + vocab_ids)
+        familiarities = dict(self.cur.fetchall())
+        for vocab_id in vocab_ids:
+            if vocab_id not in familiarities:
+                raise RuntimeError(
+                    f'Cannot find {vocab_id} for user {user_id}')
+        return familiarities
+
+    def vocab_familiarities(self, vocab_id: int, user_ids):
+        """
+        Returns a dict of user id to familiarity of a vocab for several users.
+        Users who have not unlocked the vocab are left out.
+        """
+        user_ids = list(user_ids)
+        marks = ', '.join('?' * len(user_ids))
+        self.cur.execute(f"SELECT user_id, familiarity FROM 'user-to-vocab' \
+            WHERE vocab_id = ? AND user_id IN ({marks})", [vocab_id] + user_ids)
+        return dict(self.cur.fetchall())
+
     def __unlock_vocab(self, user_id: int, set_id: int, new_level: int):
         """
         Updates the [user-to-vocab] table with vocabulary associated with
@@ -94,16 +502,43 @@ class Database():
             set_id: desired set to add
             new_level: specific level from the set to add to user
         """
+        # Vocab the user already has, such as vocab a content update moved
+        # to a later level, is not added twice.
+        self.cur.execute("INSERT INTO 'user-to-vocab' \
+            (user_id, vocab_id, times_correct, times_shown, familiarity) \
+            SELECT ?, sv.vocab_id, 0, 0, 0 FROM 'set-to-vocab' AS sv \
+            WHERE sv.set_id = ? AND sv.level = ? AND NOT EXISTS ( \
+            SELECT * FROM 'user-to-vocab' AS uv \
+            WHERE uv.user_id = ? AND uv.vocab_id = sv.vocab_id)",
+                         [user_id, set_id, new_level, user_id])
+        new_vocab = self.cur.rowcount
+        # new vocab starts at familiarity 0
         self.cur.execute(
-            "SELECT vocab_id FROM 'set-to-vocab' WHERE set_id = ? AND level = ?",
-            [set_id, new_level])
-        new_vocab_ids = tuple(self.cur.fetchall())
-        for entry in new_vocab_ids:
-            vocab_id = entry[0]
-            self.cur.execute("INSERT INTO 'user-to-vocab' \
-                (user_id, vocab_id, times_correct, times_shown, familiarity) \
-                VALUES (?, ?, 0, 0, 0)", (user_id, vocab_id))
-        self.con.commit()
+            "UPDATE 'unlocked-sets' SET unfamiliar_count = unfamiliar_count + ? \
+                WHERE user_id = ? AND set_id = ?",
+            [new_vocab, user_id, set_id])
+        self.__bump_stats([(user_id, 0, 0, 0, new_vocab)])
+
+    def refresh_set_counts(self, set_id: int):
+        """
+        Recomputes the unfamiliar_count of every user of a set and the vocab
+        count in their [user_stats], after the vocab of the set changed.
+        The changes are left uncommitted.
+
+        Arguments:
+            set_id: set whose vocab changed
+        """
+        self.cur.execute("UPDATE 'unlocked-sets' SET unfamiliar_count = ( \
+            SELECT COUNT(*) FROM 'user-to-vocab' AS uv \
+            INNER JOIN 'set-to-vocab' AS sv USING (vocab_id) \
+            WHERE uv.user_id = 'unlocked-sets'.user_id \
+            AND sv.set_id = 'unlocked-sets'.set_id AND uv.familiarity < 5) \
+            WHERE set_id = ?", [set_id])
+        self.cur.execute("UPDATE 'user_stats' SET vocab_count = ( \
+            SELECT COUNT(*) FROM 'user-to-vocab' AS uv \
+            WHERE uv.user_id = 'user_stats'.user_id) \
+            WHERE user_id IN ( \
+            SELECT user_id FROM 'unlocked-sets' WHERE set_id = ?)", [set_id])
 
     def unlock_set(self, user_id: int, set_id: int):
         """
@@ -116,13 +551,20 @@ class Database():
         Arguments:
             user_id: Discord user id
             set_id: desired set to unlock
+        Returns:
+            bool of whether the set was unlocked, False if the user already
+            had it
         """
         self.cur.execute(
-            "INSERT INTO 'unlocked-sets' (user_id, set_id, current_level) \
-                VALUES (?, ?, 1);",
+            "INSERT OR IGNORE INTO 'unlocked-sets' (user_id, set_id, \
+                current_level) VALUES (?, ?, 1);",
             (user_id, set_id))
-        self.__unlock_vocab(user_id, set_id, 1)
-        self.con.commit()
+        unlocked = self.cur.rowcount > 0
+        if unlocked:
+            self.__bump_stats([(user_id, 1, 0, 0, 0)])
+            self.__unlock_vocab(user_id, set_id, 1)
+        self.__commit()
+        return unlocked
 
     def check_level_up(self, user_id: int):
         """
@@ -130,7 +572,8 @@ class Database():
         conditions are met.
 
         A player can level up if all words in the active set are familiarity
-        5 or higher.
+        5 or higher, which is tracked by the unfamiliar_count column of
+        [unlocked-sets].
 
         Arguments:
             user_id: Discord user id
@@ -138,8 +581,10 @@ class Database():
             Pair of (int, bool) where
             - Int of player's new level if they leveled up, or None
             - Bool of whether user has leveled up
+        Raises:
+            RuntimeError if the user or their active set doesn't exist
         """
-        def level_up(user_id: int, set_id: int):
+        def level_up(user_id: int, set_id: int, new_level: int):
             """
             Levels up the user's set.
 
@@ -150,34 +595,36 @@ class Database():
             Arguments:
                 user_id: Discord user id
                 set_id: desired set to level up
-            Returns:
-                int of player's new level for this set
+                new_level: level the set is raised to
             """
             self.cur.execute(
-                "UPDATE 'unlocked-sets' SET current_level = current_level + 1 \
-                    WHERE user_id = ?;",
-                [user_id])
-            new_level = self.current_level(user_id, set_id)
+                "UPDATE 'unlocked-sets' SET current_level = ? \
+                    WHERE user_id = ? AND set_id = ?;",
+                [new_level, user_id, set_id])
+            self.__bump_stats([(user_id, 1, 0, 0, 0)])
             self.__unlock_vocab(user_id, set_id, new_level)
-            self.con.commit()
-            return new_level
+            self.__commit()
 
-        active_set = self.active_set_id(user_id)
-        current_level = self.current_level(user_id, active_set)
-        max_level = self.max_level(active_set)
+        self.cur.execute(
+            "SELECT us.set_id, us.current_level, s.total_levels, \
+            us.unfamiliar_count FROM 'users' AS u \
+            INNER JOIN 'unlocked-sets' AS us \
+            ON us.user_id = u.user_id AND us.set_id = u.active_set_id \
+            INNER JOIN 'sets' AS s ON s.set_id = us.set_id \
+            WHERE u.user_id = ?", [user_id])
+        row = self.cur.fetchone()
+        if row == None:
+            raise RuntimeError(
+                f'User {user_id} does not exist or has no active set')
+        active_set, current_level, max_level, unfamiliar_count = row
         if current_level == max_level:  # do not level up if already max level
             return None, False
 
-        self.cur.execute(
-            "SELECT familiarity FROM 'user-to-vocab' WHERE user_id = ? \
-            AND familiarity < 5 AND vocab_id IN ( \
-            SELECT vocab_id FROM 'set-to-vocab' WHERE set_id = ?)",
-            [user_id, active_set]
-        )
-        can_level_up = len(self.cur.fetchall()) == 0
+        can_level_up = unfamiliar_count == 0
         new_level = None
         if can_level_up:
-            new_level = level_up(user_id, active_set)
+            new_level = current_level + 1
+            level_up(user_id, active_set, new_level)
         return new_level, can_level_up
 
     def create_user(self, user_id: int):
@@ -186,12 +633,17 @@ class Database():
 
         Arguments:
             user_id: Discord user id
+        Returns:
+            bool of whether the user was added, False if they already existed
         """
         self.cur.execute(
-            "INSERT INTO 'users'(user_id, active_set_id) VALUES (?, 1);",
-            [user_id])
+            "INSERT OR IGNORE INTO 'users'(user_id, active_set_id) \
+                VALUES (?, 1);", [user_id])
+        if self.cur.rowcount == 0:
+            self.__commit()
+            return False
         self.unlock_set(user_id, 1)
-        self.con.commit()
+        return True
 
     def player_vocab(self, user_id: int, familiarity_level, set_id: int = None):
         """
@@ -215,6 +667,126 @@ class Database():
                          [user_id, familiarity_level, set_id, max_level])
         return self.cur.fetchall()
 
+    def sample_question(self, user_id: int, bin_weights):
+        """
+        Picks a vocab word from the user's active set, choosing its familiarity
+        bin by weight.
+
+        Each non-empty bin is chosen with probability proportional to its
+        weight, the same as drawing bins in weighted random order and keeping
+        the first non-empty one. A word is then chosen uniformly from the bin.
+
+        Arguments:
+            user_id: Discord user id
+            bin_weights: sequence of 10 weights, one per familiarity level
+        Returns:
+            Triple of (vocab_id, native character, romanization), or None if
+            the user has no vocab available in their active set.
+        """
+        self.cur.execute(f"SELECT familiarity, COUNT(*) FROM 'user-to-vocab' \
+            WHERE user_id = ? AND vocab_id IN ({ACTIVE_VOCAB}) \
+            GROUP BY familiarity", [user_id, user_id])
+        counts = dict(self.cur.fetchall())
+        bins = [level for level in counts if bin_weights[level] > 0]
+        if len(bins) == 0:
+            return None
+        weights = [bin_weights[level] for level in bins]
+        familiarity = random.choices(bins, weights=weights)[0]
+        offset = random.randrange(counts[familiarity])
+        self.cur.execute(f"SELECT vocab_id, char_native, romanization \
+            FROM 'user-to-vocab' INNER JOIN 'vocab' USING (vocab_id) \
+            WHERE user_id = ? AND familiarity = ? \
+            AND vocab_id IN ({ACTIVE_VOCAB}) LIMIT 1 OFFSET ?",
+                         [user_id, familiarity, user_id, offset])
+        return self.cur.fetchone()
+
+    def sample_deck(self, user_id: int, bin_weights, size: int):
+        """
+        Picks several vocab words from the user's active set in one query.
+
+        Every draw chooses a non-empty familiarity bin by weight and a word
+        uniformly from that bin, like sample_question. Words are not repeated
+        until every available word has been drawn.
+
+        Arguments:
+            user_id: Discord user id
+            bin_weights: sequence of 10 weights, one per familiarity level
+            size: number of words to draw
+        Returns:
+            List of (vocab_id, native character, romanization) triples, empty
+            if the user has no vocab available in their active set.
+        """
+        self.cur.execute(f"SELECT familiarity, vocab_id, char_native, \
+            romanization FROM 'user-to-vocab' INNER JOIN 'vocab' USING (vocab_id) \
+            WHERE user_id = ? AND vocab_id IN ({ACTIVE_VOCAB})",
+                         [user_id, user_id])
+        return draw_deck(self.cur.fetchall(), bin_weights, size)
+
+    def user_progress(self, user_id: int):
+        """
+        Reads everything a quiz turn needs to know about a user at once.
+
+        Arguments:
+            user_id: Discord user id
+        Returns:
+            Tuple of (active set id, dict of set id to current level, dict of
+            vocab id to familiarity, list of (vocab_id, native character,
+            romanization) of the active set up to its current level), or None
+            if the user doesn't exist
+        """
+        self.cur.execute(
+            "SELECT active_set_id FROM 'users' WHERE user_id = ?", [user_id])
+        row = self.cur.fetchone()
+        if row == None:
+            return None
+        self.cur.execute("SELECT set_id, current_level FROM 'unlocked-sets' \
+            WHERE user_id = ?", [user_id])
+        levels = dict(self.cur.fetchall())
+        self.cur.execute("SELECT vocab_id, familiarity FROM 'user-to-vocab' \
+            WHERE user_id = ?", [user_id])
+        familiarity = dict(self.cur.fetchall())
+        self.cur.execute(f"SELECT vocab_id, char_native, romanization \
+            FROM 'vocab' WHERE vocab_id IN ({ACTIVE_VOCAB})", [user_id])
+        return row[0], levels, familiarity, self.cur.fetchall()
+
+    def due_vocab(self, user_id: int, size: int, now: int = None):
+        """
+        Picks the vocab of the user's active set that is most overdue for
+        review, earliest due first.
+
+        The words are read in next_due order from the (user_id, next_due)
+        index, so the cost does not grow with the size of the user's vocab.
+
+        Arguments:
+            user_id: Discord user id
+            size: largest number of words to return
+            now: unix time to compare due times with. Defaults to now.
+        Returns:
+            List of (vocab_id, native character, romanization) triples, empty
+            if nothing in the active set is due.
+        """
+        if now == None:
+            now = int(time.time())
+        self.cur.execute(f"SELECT vocab_id, char_native, romanization \
+            FROM 'user-to-vocab' INNER JOIN 'vocab' USING (vocab_id) \
+            WHERE user_id = ? AND next_due <= ? \
+            AND vocab_id IN ({ACTIVE_VOCAB}) ORDER BY next_due LIMIT ?",
+                         [user_id, now, user_id, size])
+        return self.cur.fetchall()
+
+    def next_review(self, user_id: int):
+        """
+        Returns the unix time at which the next vocab of the user's active set
+        is due for review, or None if the active set has no vocab.
+
+        Arguments:
+            user_id: Discord user id
+        """
+        self.cur.execute(f"SELECT MIN(next_due) FROM 'user-to-vocab' \
+            WHERE user_id = ? AND vocab_id IN ({ACTIVE_VOCAB})",
+                         [user_id, user_id])
+        return self.cur.fetchone()[0]
+
     def as_defn_pair(self, vocab_id: int):
         """
         Returns a pair of the native character and its romanization
@@ -245,23 +817,84 @@ class Database():
             user_id: Discord user id
             vocab_id: vocab that was asked to user
             correct: whether the user answered correctly or not
+        Raises:
+            RuntimeError if user_id, vocab_id pair is invalid
+        """
+        updated = self.apply_answers([(user_id, vocab_id, [correct])])
+        self.__commit()
+        if not updated:
+            raise RuntimeError(f'Cannot find {vocab_id} for user {user_id}')
+
+    @staticmethod
+    def next_familiarity(familiarity: int, correct: bool) -> int:
+        """
+        Returns the familiarity of a vocab after an answer.
+
+        Arguments:
+            familiarity: familiarity before the answer
+            correct: whether the user answered correctly or not
         """
-        familiarity = self.familiarity(user_id, vocab_id)
         if correct:
-            correct_int = 1
-            familiarity = min(familiarity + 1, 9)
-        else:
-            correct_int = 0
-            if familiarity == 9:
-                familiarity = 6
-            else:
-                familiarity = max(familiarity - 1, 0)
-        self.cur.execute(
+            return min(familiarity + 1, 9)
+        if familiarity == 9:
+            return 6
+        return max(familiarity - 1, 0)
+
+    def apply_answers(self, answers, asked_at: int = None):
+        """
+        Writes a batch of answer results without committing.
+
+        The stored familiarity of every answered vocab is read under the
+        write lock and moved by each answer in turn, so answers queued by
+        other connections or processes are built on rather than overwritten.
+        Every answered vocab is marked as asked and scheduled for review
+        after the REVIEW_INTERVALS entry of its new familiarity. The
+        unfamiliar_count of every set containing the vocab is adjusted when
+        the familiarity crosses 5, and the answer totals in [user_stats] are
+        updated.
+
+        Arguments:
+            answers: list of (user_id, vocab_id, list of whether each answer
+                was correct, in the order they were given)
+            asked_at: unix time of the answers. Defaults to now.
+        Returns:
+            List of the (user_id, vocab_id) pairs that were updated. Vocab
+            the user has not unlocked is skipped.
+        """
+        if asked_at == None:
+            asked_at = int(time.time())
+        if not answers:
+            return []
+        if not self.con.in_transaction:
+            # the familiarity must not change between reading and writing it
+            self.cur.execute('BEGIN IMMEDIATE')
+        updates = []
+        crossings = []
+        for user_id, vocab_id, outcomes in answers:
+            self.cur.execute("SELECT familiarity FROM 'user-to-vocab' \
+                WHERE user_id = ? AND vocab_id = ?", [user_id, vocab_id])
+            row = self.cur.fetchone()
+            if row == None:
+                continue
+            old = new = row[0]
+            for correct in outcomes:
+                new = Database.next_familiarity(new, correct)
+            updates.append((sum(map(bool, outcomes)), len(outcomes), new,
+                            asked_at, asked_at + REVIEW_INTERVALS[new],
+                            user_id, vocab_id))
+            if (new < 5) != (old < 5):
+                crossings.append(((new < 5) - (old < 5), user_id, vocab_id))
+        self.cur.executemany(
             "UPDATE 'user-to-vocab' SET times_correct = times_correct + ?, \
-            times_shown = times_shown + 1, familiarity = ? \
-            WHERE user_id = ? AND vocab_id = ?;",
-            [correct_int, familiarity, user_id, vocab_id])
-        self.con.commit()
+            times_shown = times_shown + ?, familiarity = ?, last_asked = ?, \
+            next_due = ? WHERE user_id = ? AND vocab_id = ?;", updates)
+        self.cur.executemany(
+            "UPDATE 'unlocked-sets' SET unfamiliar_count = unfamiliar_count + ? \
+            WHERE user_id = ? AND set_id IN ( \
+            SELECT set_id FROM 'set-to-vocab' WHERE vocab_id = ?)", crossings)
+        self.__bump_stats([(user_id, 0, correct, shown, 0)
+                           for correct, shown, _, _, _, user_id, _ in updates])
+        return [(user_id, vocab_id) for *_, user_id, vocab_id in updates]
 
     class Set():
         def __init__(self, set_id, name, current_level, total_levels, unlock_desc=None):
@@ -349,6 +982,131 @@ class Database():
             WHERE user_id = ?", [user_id])
         return self.cur.fetchone()[0]
 
+    def user_stats(self, user_id: int):
+        """
+        Returns the profile totals of the user from [user_stats].
+
+        Arguments:
+            user_id: Discord user id
+        Returns:
+            Tuple of (total level, times correct, times shown, vocab count),
+            or None if the user has no stats.
+        """
+        self.cur.execute("SELECT total_level, times_correct, times_shown, \
+            vocab_count FROM 'user_stats' WHERE user_id = ?", [user_id])
+        return self.cur.fetchone()
+
+    def rebuild_user_stats(self, fix: bool = True):
+        """
+        Recomputes [user_stats] from the [unlocked-sets] and [user-to-vocab]
+        tables and reports where the stored totals drifted.
+
+        Arguments:
+            fix: replace the stored totals with the recomputed ones
+        Returns:
+            List of (user_id, stored totals, recomputed totals) for every user
+            whose stored totals differ. Missing totals are None.
+        """
+        self.cur.execute(USER_STATS_QUERY)
+        actual = {row[0]: row[1:] for row in self.cur.fetchall()}
+        self.cur.execute("SELECT user_id, total_level, times_correct, \
+            times_shown, vocab_count FROM 'user_stats'")
+        stored = {row[0]: row[1:] for row in self.cur.fetchall()}
+        drift = []
+        for user_id in actual.keys() | stored.keys():
+            if actual.get(user_id) != stored.get(user_id):
+                drift.append(
+                    (user_id, stored.get(user_id), actual.get(user_id)))
+        if fix:
+            self.cur.execute("DELETE FROM 'user_stats'")
+            self.cur.executemany(
+                "INSERT INTO 'user_stats' (user_id, total_level, \
+                times_correct, times_shown, vocab_count) \
+                VALUES (?, ?, ?, ?, ?)",
+                [(user_id,) + totals for user_id, totals in actual.items()])
+            self.__commit()
+        return drift
+
+    def rebuild_unfamiliar_counts(self, fix: bool = True):
+        """
+        Recomputes the unfamiliar_count of every row of [unlocked-sets] and
+        reports where the stored counts drifted.
+
+        Arguments:
+            fix: replace the drifted counts with the recomputed ones
+        Returns:
+            List of (user_id, set_id, stored count, recomputed count) for
+            every unlocked set whose stored count differs
+        """
+        self.cur.execute("SELECT us.user_id, us.set_id, us.unfamiliar_count, ( \
+            SELECT COUNT(*) FROM 'user-to-vocab' AS uv \
+            INNER JOIN 'set-to-vocab' AS sv USING (vocab_id) \
+            WHERE uv.user_id = us.user_id AND sv.set_id = us.set_id \
+            AND uv.familiarity < 5) FROM 'unlocked-sets' AS us")
+        drift = [row for row in self.cur.fetchall() if row[2] != row[3]]
+        if fix and drift:
+            self.cur.executemany(
+                "UPDATE 'unlocked-sets' SET unfamiliar_count = ? \
+                WHERE user_id = ? AND set_id = ?",
+                [(actual, user_id, set_id)
+                 for user_id, set_id, _, actual in drift])
+            self.__commit()
+        return drift
+
+    def scores(self, user_ids):
+        """
+        Returns a dict of user id to (total level, times correct) for several
+        users. Users without stats are left out.
+        """
+        user_ids = list(user_ids)
+        marks = ', '.join('?' * len(user_ids))
+        self.cur.execute(f"SELECT user_id, total_level, times_correct \
+            FROM 'user_stats' WHERE user_id IN ({marks})", user_ids)
+        return {user_id: (level, correct)
+                for user_id, level, correct in self.cur.fetchall()}
+
+    def top_scores(self, size: int):
+        """
+        Returns the highest scoring users, read in order from the score index.
+
+        Arguments:
+            size: number of users to return
+        Returns:
+            List of (user_id, total level, times correct), best first
+        """
+        self.cur.execute("SELECT user_id, total_level, times_correct \
+            FROM 'user_stats' ORDER BY total_level DESC, times_correct DESC \
+            LIMIT ?", [size])
+        return self.cur.fetchall()
+
+    def guild_top_scores(self, guild_id: int, size: int):
+        """
+        Returns the highest scoring users who have played in a guild.
+
+        Arguments:
+            guild_id: Discord guild id
+            size: number of users to return
+        Returns:
+            List of (user_id, total level, times correct), best first
+        """
+        self.cur.execute("SELECT user_id, total_level, times_correct \
+            FROM 'guild_members' INNER JOIN 'user_stats' USING (user_id) \
+            WHERE guild_id = ? ORDER BY total_level DESC, times_correct DESC \
+            LIMIT ?", [guild_id, size])
+        return self.cur.fetchall()
+
+    def add_guild_member(self, guild_id: int, user_id: int):
+        """
+        Records that a user has played in a guild.
+
+        Arguments:
+            guild_id: Discord guild id
+            user_id: Discord user id
+        """
+        self.cur.execute("INSERT OR IGNORE INTO 'guild_members' \
+            (guild_id, user_id) VALUES (?, ?)", [guild_id, user_id])
+        self.__commit()
+
     def native_to_vocab_id(self, native_char: str) -> int:
         """
         Returns the vocabulary id of a native character.
@@ -362,13 +1120,14 @@ class Database():
 
     def set_name_to_id(self, name: str) -> int:
         """
-        Returns the set id of a set name.
+        Returns the set id of a set name, ignoring case.
 
         Arguments:
             name: entry in name column of database's sets table
         """
         name = name.strip()
-        self.cur.execute("SELECT set_id FROM 'sets' WHERE name LIKE ?", [name])
+        self.cur.execute(
+            "SELECT set_id FROM 'sets' WHERE name = ? COLLATE NOCASE", [name])
         return self.cur.fetchone()[0]
 
     class Vocab():
@@ -419,6 +1178,44 @@ class Database():
             obj_list.append(user_vocab)
         return obj_list
 
+    def dict_page(self, user_id: int, set_id: int, page: int, page_size: int):
+        """
+        Returns one page of a user's dictionary for a set in a single query.
+
+        The dictionary has a learning section of familiarity 0 to 4 and a
+        reviewing section of familiarity 5 to 8. Both sections are paged
+        together, ordered by vocab id.
+
+        Arguments:
+            user_id: Discord user id
+            set_id: entry in set_id column of database's sets table
+            page: zero-based page number
+            page_size: number of entries of each section on a page
+        Returns:
+            Pair of (learning, reviewing) sections. Each is a pair of the
+            section's total entry count and a list of (native character,
+            romanization) on this page.
+        """
+        first = page * page_size
+        self.cur.execute("SELECT section, row_num, total, char_native, \
+            romanization FROM ( \
+            SELECT familiarity >= 5 AS section, char_native, romanization, \
+            ROW_NUMBER() OVER (PARTITION BY familiarity >= 5 \
+                ORDER BY vocab_id) AS row_num, \
+            COUNT(*) OVER (PARTITION BY familiarity >= 5) AS total \
+            FROM 'user-to-vocab' INNER JOIN 'vocab' USING (vocab_id) \
+            WHERE user_id = ? AND familiarity <= 8 AND vocab_id IN ( \
+            SELECT vocab_id FROM 'set-to-vocab' WHERE set_id = ?)) \
+            WHERE row_num = 1 OR (row_num > ? AND row_num <= ?) \
+            ORDER BY section, row_num",
+                         [user_id, set_id, first, first + page_size])
+        sections = ([0, []], [0, []])
+        for section, row_num, total, native, romaji in self.cur.fetchall():
+            sections[section][0] = total
+            if first < row_num <= first + page_size:
+                sections[section][1].append((native, romaji))
+        return tuple(tuple(section) for section in sections)
+
     def set_is_unlocked(self, user_id: int, set_id: int) -> bool:
         """
         Returns True if the set id is unlocked by user and False otherwise.
@@ -441,9 +1238,115 @@ class Database():
         self.cur.execute(
             "UPDATE 'users' SET active_set_id = ? \
                     WHERE user_id = ?;", [set_id, user_id])
+        self.__commit()
+
+    def catalog(self, snapshot: str = None):
+        """
+        Returns a VocabCatalog of the current vocab and sets.
+
+        Arguments:
+            snapshot: location of a catalog snapshot file. The snapshot is
+                used if it is up to date, and rewritten otherwise.
+        """
+        if snapshot == None:
+            return catalog.VocabCatalog.load(self.cur)
+        return catalog.VocabCatalog.load_snapshot(
+            self.cur, snapshot, self.catalog_version())
+
+    def catalog_version(self) -> int:
+        """
+        Returns a number that changes whenever the vocab, sets or
+        set-to-vocab tables change.
+        """
+        self.cur.execute("SELECT version FROM 'catalog_version'")
+        return self.cur.fetchone()[0]
 
     def max_level(self, set_id: int):
         """ Returns the maximum level of the given set"""
         self.cur.execute(
             "SELECT total_levels FROM 'sets' WHERE set_id = ?", [set_id])
         return self.cur.fetchone()[0]
+
+    def guild_prefixes(self):
+        """ Returns a dict of every guild id with a stored prefix. """
+        self.cur.execute("SELECT guild_id, prefix FROM 'guilds'")
+        return dict(self.cur.fetchall())
+
+    def set_guild_prefix(self, guild_id: int, prefix: str):
+        """
+        Changes the prefix of a guild, adding the guild if needed.
+
+        Arguments:
+            guild_id: Discord guild id
+            prefix: new command prefix
+        """
+        self.cur.execute(
+            "INSERT INTO 'guilds' (guild_id, prefix) VALUES (?, ?) \
+                ON CONFLICT (guild_id) DO UPDATE SET prefix = excluded.prefix",
+            [guild_id, prefix])
+        self.__commit()
+
+    def remove_guild(self, guild_id: int):
+        """ Deletes the settings of a guild. """
+        self.cur.execute(
+            "DELETE FROM 'guilds' WHERE guild_id = ?", [guild_id])
+        self.__commit()
+
+    def import_guilds(self, prefixes) -> int:
+        """
+        Adds guild prefixes in bulk. Guilds that are already stored keep
+        their prefix.
+
+        Arguments:
+            prefixes: dict of guild id to prefix
+        Returns:
+            int of the number of guilds added
+        """
+        self.cur.executemany(
+            "INSERT OR IGNORE INTO 'guilds' (guild_id, prefix) VALUES (?, ?)",
+            [(int(guild_id), prefix) for guild_id, prefix in prefixes.items()])
+        added = self.cur.rowcount
+        self.__commit()
+        return added
+
+    def post_shard_command(self, command: str, argument: str, origin: str):
+        """
+        Records an owner command for every bot process to carry out.
+
+        Arguments:
+            command: name of the command
+            argument: argument of the command, or None
+            origin: id of the process that issued the command
+        Returns:
+            int of the new command id
+        """
+        self.cur.execute(
+            "INSERT INTO 'shard_commands' (command, argument, origin) \
+                VALUES (?, ?, ?)", [command, argument, origin])
+        command_id = self.cur.lastrowid
+        self.__commit()
+        return command_id
+
+    def shard_commands_since(self, command_id: int):
+        """
+        Returns a list of (command_id, command, argument, origin) of every
+        owner command after the given id, oldest first.
+        """
+        self.cur.execute(
+            "SELECT command_id, command, argument, origin \
+                FROM 'shard_commands' WHERE command_id > ? \
+                ORDER BY command_id", [command_id])
+        return self.cur.fetchall()
+
+    def last_shard_command_id(self) -> int:
+        """ Returns the id of the newest owner command, or 0 if none. """
+        self.cur.execute("SELECT IFNULL(MAX(command_id), 0) FROM 'shard_commands'")
+        return self.cur.fetchone()[0]
+
+    def data_version(self) -> int:
+        """
+        Returns a number that changes whenever another connection, such as
+        one in a different bot process, commits to the database.
+        """
+        self.cur.execute('PRAGMA data_version')
+        return self.cur.fetchone()[0]
@@ -0,0 +1,153 @@
+import collections
+import hashlib
+import json
+import time
+import traceback
+
+
+class ErrorGroup():
+    """ Occurrences of errors that share a fingerprint. """
+
+    __slots__ = ('fingerprint', 'type', 'message', 'context', 'count',
+                 'first_seen', 'last_seen', 'unsaved')
+
+    def __init__(self, fingerprint: str, type: str, message: str,
+                 context: str, now: float):
+        self.fingerprint = fingerprint
+        self.type = type
+        self.message = message
+        self.context = context
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+        # occurrences not yet written by save
+        self.unsaved = 0
+
+
+class ErrorTracker():
+    """
+    Collects unhandled errors of commands and events in memory.
+
+    Errors are grouped by a fingerprint of their type and the functions of
+    their traceback, leaving out the message, so the same bug is counted
+    once however often it happens. The most recent tracebacks are kept in a
+    ring buffer without their source lines, which are only read when a
+    traceback is shown or saved.
+
+    Capturing an error only updates memory. save writes what was captured
+    since the previous save as JSON lines, one per error group with the
+    number of new occurrences and, for groups new to the file, a traceback.
+    It does blocking file IO and is meant to run off the event loop.
+    """
+
+    def __init__(self, path: str, recent: int = 100):
+        """
+        Arguments:
+            path: location of the JSON lines file errors are saved to
+            recent: number of tracebacks kept in the ring buffer
+        """
+        self.path = path
+        self.groups = {}
+        # (time, fingerprint, context, TracebackException), newest last
+        self.recent = collections.deque(maxlen=recent)
+        self.captured = 0
+        # fingerprints whose traceback has not been saved yet
+        self._new = []
+
+    @staticmethod
+    def fingerprint(exc: BaseException) -> str:
+        """ Returns a short hash of the type and traceback functions of exc. """
+        parts = [f'{type(exc).__module__}.{type(exc).__qualname__}']
+        for frame, _ in traceback.walk_tb(exc.__traceback__):
+            code = frame.f_code
+            parts.append(f'{code.co_filename}:{code.co_name}')
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()[:12]
+
+    def capture(self, exc: BaseException, context: str):
+        """
+        Records an error.
+
+        Arguments:
+            exc: the exception, with its traceback
+            context: where the error happened, such as 'command quiz'
+        Returns:
+            str of the fingerprint of the error
+        """
+        now = time.time()
+        fingerprint = ErrorTracker.fingerprint(exc)
+        group = self.groups.get(fingerprint)
+        if group is None:
+            group = self.groups[fingerprint] = ErrorGroup(
+                fingerprint, type(exc).__name__, str(exc), context, now)
+            self._new.append(fingerprint)
+        group.count += 1
+        group.unsaved += 1
+        group.last_seen = now
+        self.recent.append((now, fingerprint, context,
+                            traceback.TracebackException.from_exception(
+                                exc, lookup_lines=False)))
+        self.captured += 1
+        return fingerprint
+
+    def top(self, n: int = 10):
+        """ Returns the n ErrorGroups that happened most often. """
+        return sorted(self.groups.values(),
+                      key=lambda group: group.count, reverse=True)[:n]
+
+    def latest_traceback(self, fingerprint: str):
+        """
+        Returns the traceback.TracebackException of the most recent error
+        with a fingerprint in the ring buffer, or None. Call on the event
+        loop, which is the only one to change the ring buffer. Formatting
+        the traceback reads source files, so it belongs off the loop.
+        """
+        for _, entry_fingerprint, _, tb in reversed(list(self.recent)):
+            if entry_fingerprint == fingerprint:
+                return tb
+        return None
+
+    def take_unsaved(self):
+        """
+        Collects the error groups that changed since the last call, to be
+        written by save. Call on the event loop.
+
+        Returns:
+            List of dicts, one per changed group
+        """
+        new = set(self._new)
+        tracebacks = {}
+        for _, fingerprint, _, tb in self.recent:
+            if fingerprint in new:
+                tracebacks[fingerprint] = tb
+        self._new = []
+        entries = []
+        for group in self.groups.values():
+            if group.unsaved == 0:
+                continue
+            entries.append({
+                'time': group.last_seen,
+                'fingerprint': group.fingerprint,
+                'type': group.type,
+                'message': group.message,
+                'context': group.context,
+                'count': group.unsaved,
+                'total': group.count,
+                'traceback': tracebacks.get(group.fingerprint),
+            })
+            group.unsaved = 0
+        return entries
+
+    def save(self, entries):
+        """
+        Appends entries from take_unsaved to the error file. Blocking.
+        """
+        if not entries:
+            return
+        lines = []
+        for entry in entries:
+            tb = entry['traceback']
+            if tb is not None:
+                entry = dict(entry, traceback=''.join(tb.format()))
+            lines.append(json.dumps(entry))
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
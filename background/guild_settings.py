@@ -0,0 +1,83 @@
+import json
+import os
+
+
+class GuildSettings():
+    """
+    In-memory cache of per-guild settings backed by the [guilds] table.
+
+    Every stored prefix is read in bulk by load before the bot starts, so
+    looking up a prefix never touches the database. Each change is written
+    through to memory immediately and persisted as a single-row upsert or
+    delete, committed with the database's next group.
+    """
+
+    def __init__(self, db, default_prefix: str):
+        """
+        Arguments:
+            db: AsyncDatabase holding the [guilds] table
+            default_prefix: prefix used for guilds without a stored prefix
+        """
+        self.db = db
+        self.default_prefix = default_prefix
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.prefixes = {}
+
+    async def load(self, legacy_path: str = None):
+        """
+        Reads every stored prefix into memory.
+
+        Arguments:
+            legacy_path: location of the guild settings JSON file used by
+                older versions of the bot. If it exists, its prefixes are
+                imported once and the file is renamed so it is not imported
+                again.
+        Returns:
+            int of the number of guilds imported from the JSON file
+        """
+        imported = 0
+        guilds = None
+        if legacy_path != None:
+            try:
+                with open(legacy_path, 'r') as f:
+                    guilds = json.load(f)
+            except FileNotFoundError:
+                pass
+        if guilds != None:
+            imported = await self.db.import_guilds(
+                {guild_id: settings['prefix']
+                 for guild_id, settings in guilds.items()
+                 if 'prefix' in settings})
+            await self.db.flush()
+            try:
+                os.replace(legacy_path, f'{legacy_path}.imported')
+            except FileNotFoundError:
+                pass  # another bot process imported it at the same time
+        self.prefixes = await self.db.guild_prefixes()
+        return imported
+
+    def prefix(self, guild_id: int) -> str:
+        """
+        Returns the prefix of a guild, or the default prefix if the guild has
+        no stored settings.
+        """
+        prefix = self.prefixes.get(guild_id)
+        if prefix is None:
+            self.misses += 1
+            return self.default_prefix
+        self.hits += 1
+        return prefix
+
+    async def set_prefix(self, guild_id: int, prefix: str):
+        """ Changes the prefix of a guild, creating its settings if needed. """
+        self.prefixes[guild_id] = prefix
+        self.writes += 1
+        await self.db.set_guild_prefix(guild_id, prefix)
+
+    async def remove(self, guild_id: int):
+        """ Forgets all settings of a guild. """
+        if self.prefixes.pop(guild_id, None) is not None:
+            self.writes += 1
+            await self.db.remove_guild(guild_id)
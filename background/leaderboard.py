@@ -0,0 +1,196 @@
+import bisect
+import collections
+
+
+class TopK():
+    """
+    The users with the k highest scores, kept in order.
+
+    A score is a pair of (total level, times correct), compared in that
+    order. Scores only ever grow, so a user who drops out of the top k can
+    only return through a later change of their own score, which is offered
+    when it happens. That keeps the top k exact without holding every
+    user's score. Offering a score takes O(k) at worst, independent of the
+    number of users.
+    """
+
+    def __init__(self, size: int, entries=()):
+        """
+        Arguments:
+            size: number of users kept
+            entries: initial (user_id, total level, times correct) rows
+        """
+        self.size = size
+        # sorted (-total level, -times correct, user_id), best first
+        self._keys = []
+        self._by_user = {}
+        for user_id, level, correct in entries:
+            self.offer(user_id, (level, correct))
+
+    def offer(self, user_id: int, score) -> bool:
+        """
+        Updates the score of a user, who enters the top k if the score is
+        high enough.
+
+        Returns:
+            bool of whether the top k changed
+        """
+        key = (-score[0], -score[1], user_id)
+        old = self._by_user.get(user_id)
+        if old is not None:
+            if old == key:
+                return False
+            del self._keys[bisect.bisect_left(self._keys, old)]
+            del self._by_user[user_id]
+        elif len(self._keys) >= self.size and key >= self._keys[-1]:
+            return False
+        bisect.insort(self._keys, key)
+        self._by_user[user_id] = key
+        if len(self._keys) > self.size:
+            dropped = self._keys.pop()
+            del self._by_user[dropped[2]]
+        return True
+
+    def entries(self):
+        """ Returns a list of (user_id, total level, times correct), best first. """
+        return [(user_id, -level, -correct)
+                for level, correct, user_id in self._keys]
+
+
+class Leaderboard():
+    """
+    Global and per-guild leaderboards ranked by total level, then by the
+    number of correct answers.
+
+    Each leaderboard is a TopK read once from the score index of the
+    database and then kept up to date from the scores that AsyncDatabase
+    reports after each commit, so showing a leaderboard does not touch the
+    database. Guild leaderboards are loaded when first shown and the least
+    recently shown are dropped beyond max_guilds.
+
+    A guild leaderboard ranks the users who have played in the guild. The
+    guilds of recently active users are kept in memory, up to max_members
+    users, to route their score changes; older ones are only in the
+    [guild_members] table, which rebuild and first loads read.
+    """
+
+    def __init__(self, db, size: int = 10, max_guilds: int = 1024,
+                 max_members: int = 100000):
+        """
+        Arguments:
+            db: AsyncDatabase holding [user_stats] and [guild_members]
+            size: number of users on each leaderboard
+            max_guilds: number of guild leaderboards kept in memory
+            max_members: number of users whose guilds are kept in memory
+        """
+        self.db = db
+        self.size = size
+        self.max_guilds = max_guilds
+        self.max_members = max_members
+        self.global_top = None
+        self._guilds = collections.OrderedDict()
+        self._members = collections.OrderedDict()
+        # scores reported while rebuild is reading the database
+        self._replay = None
+
+    async def seen(self, user_id: int, guild_id: int):
+        """
+        Records that a user plays in a guild, so their score changes reach
+        the guild's leaderboard. Call before the user's answers are queued.
+        """
+        guilds = self._members.get(user_id)
+        if guilds is None:
+            guilds = self._members[user_id] = set()
+            while len(self._members) > self.max_members:
+                self._members.popitem(last=False)
+        else:
+            self._members.move_to_end(user_id)
+        if guild_id not in guilds:
+            guilds.add(guild_id)
+            await self.db.add_guild_member(guild_id, user_id)
+
+    def scores_changed(self, scores):
+        """
+        Offers new scores to the leaderboards. Registered with
+        AsyncDatabase.score_listeners.
+
+        Arguments:
+            scores: dict of user id to committed (total level, times correct)
+        """
+        if self._replay is not None:
+            self._replay.append(scores)
+        for user_id, score in scores.items():
+            if self.global_top is not None:
+                self.global_top.offer(user_id, score)
+            for guild_id in self._members.get(user_id, ()):
+                board = self._guilds.get(guild_id)
+                if board is not None:
+                    board.offer(user_id, score)
+
+    async def top(self, guild_id: int = None):
+        """
+        Returns the leaderboard of a guild, or the global one if guild_id is
+        None, as a list of (user_id, total level, times correct), best first.
+        """
+        if guild_id == None:
+            if self.global_top is None:
+                self.global_top = await self._load(None)
+            return self.global_top.entries()
+        board = self._guilds.get(guild_id)
+        if board is None:
+            board = await self._load(guild_id)
+            self._guilds[guild_id] = board
+            while len(self._guilds) > self.max_guilds:
+                self._guilds.popitem(last=False)
+        else:
+            self._guilds.move_to_end(guild_id)
+        return board.entries()
+
+    def invalidate(self):
+        """
+        Drops every leaderboard, to be read again when next shown. Used when
+        another process has changed scores.
+        """
+        self.global_top = None
+        self._guilds.clear()
+
+    async def rebuild(self) -> int:
+        """
+        Reads every leaderboard in memory again from the database, as a
+        consistency check of the incremental updates.
+
+        Returns:
+            int of the number of leaderboards that differed from the database
+        """
+        self._replay = []
+        try:
+            boards = list(self._guilds.items())
+            if self.global_top is not None:
+                boards.append((None, self.global_top))
+            fresh = [(guild_id, await self._load(guild_id))
+                     for guild_id, _ in boards]
+            # scores committed while reading may be missing from the reads
+            for scores in self._replay:
+                for user_id, score in scores.items():
+                    guilds = self._members.get(user_id, ())
+                    for guild_id, board in fresh:
+                        if guild_id == None or guild_id in guilds:
+                            board.offer(user_id, score)
+        finally:
+            self._replay = None
+        drifted = 0
+        for (guild_id, board), (_, new_board) in zip(boards, fresh):
+            if board.entries() != new_board.entries():
+                drifted += 1
+            if guild_id == None:
+                self.global_top = new_board
+            elif guild_id in self._guilds:
+                self._guilds[guild_id] = new_board
+        return drifted
+
+    async def _load(self, guild_id: int):
+        if guild_id == None:
+            rows = await self.db.top_scores(self.size)
+        else:
+            rows = await self.db.guild_top_scores(guild_id, self.size)
+        return TopK(self.size, rows)
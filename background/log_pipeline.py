@@ -0,0 +1,158 @@
+import logging
+import logging.handlers
+import queue
+
+
+def parse_logger_map(value: str, convert):
+    """
+    Parses a setting of the form 'discord=DEBUG,discord.gateway=INFO'.
+
+    Arguments:
+        value: comma separated logger=value pairs, or None
+        convert: function applied to each value
+    Returns:
+        dict of logger name to converted value
+    """
+    result = {}
+    for entry in (value or '').split(','):
+        if entry.strip():
+            name, setting = entry.split('=')
+            result[name.strip()] = convert(setting.strip())
+    return result
+
+
+def level(name: str) -> int:
+    """ Returns the logging level of a name such as 'INFO' or '10'. """
+    if name.isdigit():
+        return int(name)
+    return logging.getLevelName(name.upper())
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below INFO of chosen loggers.
+
+    Sampling is by count, so keeping 0.01 of a logger's debug records keeps
+    every hundredth one. A logger without its own rate uses the rate of its
+    closest configured parent.
+    """
+
+    def __init__(self, rates):
+        """
+        Arguments:
+            rates: dict of logger name to the fraction of its records below
+                INFO that are kept
+        """
+        super().__init__()
+        self.rates = rates
+        self._seen = {}
+        self.sampled_out = 0
+
+    def _rate(self, name: str):
+        while True:
+            rate = self.rates.get(name)
+            if rate is not None or '.' not in name:
+                return rate
+            name = name.rsplit('.', 1)[0]
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.INFO:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1:
+            return True
+        seen = self._seen.get(record.name, 0) + 1
+        self._seen[record.name] = seen
+        if rate > 0 and seen % round(1 / rate) == 0:
+            return True
+        self.sampled_out += 1
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records when its bounded queue is full, instead
+    of blocking the event loop or raising.
+
+    Records are queued as they are. They are formatted by the listener
+    thread, so the arguments of a record must not be changed after it has
+    been logged, which holds for the loggers of discord.py and the bot.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # wait for room, since the queue may be full when stopping
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline():
+    """
+    Writes log records to a rotating file from a background thread.
+
+    Loggers hand their records to a DroppingQueueHandler, which only puts
+    them on a bounded queue. A QueueListener thread formats them and writes
+    them to a RotatingFileHandler. Under back-pressure, records that do not
+    fit in the queue are dropped and counted, so logging never stalls the
+    event loop. Debug records of busy loggers can be sampled before they are
+    queued.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 2 ** 20,
+                 backups: int = 5, queue_size: int = 10000,
+                 formatter: logging.Formatter = None, sample_rates=None):
+        """
+        Arguments:
+            path: location of the log file
+            max_bytes: size at which the file is rotated
+            backups: number of rotated files kept
+            queue_size: most records waiting to be written
+            formatter: formatter of the written records
+            sample_rates: dict of logger name to the fraction of its records
+                below INFO that are kept. See SampleFilter.
+        """
+        self.queue = queue.Queue(queue_size)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.sampler = SampleFilter(sample_rates or {})
+        self.handler.addFilter(self.sampler)
+        self.file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        if formatter is not None:
+            self.file_handler.setFormatter(formatter)
+        self.listener = _QueueListener(self.queue, self.file_handler)
+        self._running = False
+
+    @property
+    def dropped(self) -> int:
+        """ Number of records dropped because the queue was full. """
+        return self.handler.dropped
+
+    def attach(self, logger: logging.Logger):
+        """ Sends the records of a logger through the pipeline. """
+        logger.addHandler(self.handler)
+
+    def start(self):
+        if not self._running:
+            self.listener.start()
+            self._running = True
+
+    def stop(self):
+        """ Writes every queued record and stops the listener thread. """
+        if self._running:
+            self.listener.stop()
+            self.file_handler.close()
+            self._running = False
@@ -0,0 +1,131 @@
+import contextlib
+import os
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+class Histogram():
+    """ Latency histogram with fixed buckets. """
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics():
+    """
+    Registry of call counts, latency histograms, counters and gauges.
+
+    Histograms are grouped by kind, such as 'command' or 'query', and keyed by
+    name within a kind. Everything is kept in memory and can be rendered in
+    the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, kind: str, name: str, seconds: float):
+        """ Records the latency of one call. """
+        key = (kind, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, kind: str, name: str):
+        """ Context manager that records the latency of its body. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(kind, name, time.perf_counter() - start)
+
+    def inc(self, name: str, amount: int = 1):
+        """ Adds to a counter. """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        """ Sets a gauge to its current value. """
+        self.gauges[name] = value
+
+    def slowest(self, kind: str, n: int = 10):
+        """
+        Returns the n slowest names of a kind by mean latency.
+
+        Returns:
+            List of (name, Histogram) pairs, slowest first
+        """
+        entries = [(name, histogram)
+                   for (entry_kind, name), histogram in self.histograms.items()
+                   if entry_kind == kind]
+        entries.sort(key=lambda entry: entry[1].mean, reverse=True)
+        return entries[:n]
+
+    def render(self) -> str:
+        """ Returns every metric in the Prometheus text format. """
+        lines = []
+        kinds = sorted({kind for kind, _ in self.histograms})
+        for kind in kinds:
+            metric = f'bot_{kind}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for (entry_kind, name), histogram in sorted(self.histograms.items()):
+                if entry_kind != kind:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.buckets):
+                    cumulative += count
+                    lines.append(
+                        f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{name="{name}"}} {histogram.sum}')
+                lines.append(f'{metric}_count{{name="{name}"}} {histogram.count}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'# TYPE bot_{name}_total counter')
+            lines.append(f'bot_{name}_total {value}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'# TYPE bot_{name} gauge')
+            lines.append(f'bot_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, contents: str = None):
+        """
+        Atomically writes the rendered metrics to a file.
+
+        Arguments:
+            path: destination file
+            contents: previously rendered metrics. Rendered now if None.
+        """
+        if contents is None:
+            contents = self.render()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+
+# Registry shared by the bot, its cogs and the database layer.
+REGISTRY = Metrics()
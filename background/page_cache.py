@@ -0,0 +1,93 @@
+import collections
+import itertools
+
+
+class PageCache():
+    """
+    LRU cache of rendered pages belonging to users.
+
+    Keys are tuples that start with the user id. All of a user's pages can be
+    dropped at once when their data changes.
+
+    A page built from data that changed while it was being read must not be
+    cached. Every drop gives the user a new version number from a counter
+    that never repeats, and put skips pages whose user's version changed
+    since the build began. Versions are only kept for recently changed
+    users. Forgetting them, like clear, starts a new generation, which
+    skips every build in flight.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        """
+        Arguments:
+            max_entries: number of pages kept before the least recently used
+                one is evicted
+        """
+        self.max_entries = max_entries
+        self._pages = collections.OrderedDict()
+        self._by_user = {}
+        # user id -> version of their pages, for recently changed users
+        self._versions = {}
+        self._counter = itertools.count(1)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """ Returns the cached page for a key, or None. """
+        page = self._pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self._pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+    def version(self, user_id: int):
+        """ Returns the version of a user's pages, to be passed to put. """
+        return self._generation, self._versions.get(user_id, 0)
+
+    def put(self, key: tuple, page, version=None):
+        """
+        Caches a page, evicting the least recently used one if full.
+
+        Arguments:
+            key: tuple starting with the user id
+            page: the rendered page
+            version: the user's version from before the page was built. The
+                page is not cached if the user's pages were dropped since.
+        """
+        if version is not None and version != self.version(key[0]):
+            return
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        self._by_user.setdefault(key[0], set()).add(key)
+        while len(self._pages) > self.max_entries:
+            old_key, _ = self._pages.popitem(last=False)
+            self._forget(old_key)
+
+    def invalidate_user(self, user_id: int):
+        """ Drops every page of a user. """
+        for key in self._by_user.pop(user_id, ()):
+            self._pages.pop(key, None)
+        self._versions[user_id] = next(self._counter)
+        if len(self._versions) > 4 * self.max_entries:
+            self._versions.clear()
+            self._generation += 1
+
+    def clear(self):
+        """ Drops every page. """
+        self._pages.clear()
+        self._by_user.clear()
+        self._versions.clear()
+        self._generation += 1
+
+    def _forget(self, key: tuple):
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+
+    def __len__(self):
+        return len(self._pages)
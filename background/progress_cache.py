@@ -0,0 +1,145 @@
+import collections
+
+import background.database as database
+
+
+class UserProgress():
+    """
+    In-memory copy of one user's progress, read by Database.user_progress.
+
+    Its methods mirror the Database methods of the same name for this user,
+    including the errors they raise.
+    """
+
+    __slots__ = ('active_set', 'levels', 'vocab_familiarity', 'active_vocab')
+
+    def __init__(self, active_set_id: int, levels, familiarity, active_vocab):
+        """
+        Arguments:
+            active_set_id: id of the user's active set
+            levels: dict of unlocked set id to current level
+            familiarity: dict of unlocked vocab id to familiarity
+            active_vocab: list of (vocab_id, native character, romanization)
+                of the active set up to its current level
+        """
+        self.active_set = active_set_id
+        self.levels = levels
+        self.vocab_familiarity = familiarity
+        self.active_vocab = active_vocab
+
+    def size(self) -> int:
+        """ Returns the number of entries held, which the cache caps. """
+        return 1 + len(self.levels) + len(self.vocab_familiarity) + \
+            len(self.active_vocab)
+
+    def answered(self, vocab_id: int, correct: bool):
+        """ Moves the familiarity of an unlocked vocab by an answer. """
+        familiarity = self.vocab_familiarity.get(vocab_id)
+        if familiarity != None:
+            self.vocab_familiarity[vocab_id] = \
+                database.Database.next_familiarity(familiarity, correct)
+
+    def user_exists(self) -> bool:
+        return True
+
+    def active_set_id(self) -> int:
+        return self.active_set
+
+    def current_level(self, set_id: int) -> int:
+        try:
+            return self.levels[set_id]
+        except KeyError:
+            raise RuntimeError(f'set_id {set_id} does not belong to user')
+
+    def set_is_unlocked(self, set_id: int) -> bool:
+        return set_id in self.levels
+
+    def familiarity(self, vocab_id: int) -> int:
+        try:
+            return self.vocab_familiarity[vocab_id]
+        except KeyError:
+            raise RuntimeError(f'Cannot find {vocab_id} for user')
+
+    def familiarities(self, vocab_ids):
+        return {vocab_id: self.familiarity(vocab_id) for vocab_id in vocab_ids}
+
+    def _rows(self):
+        familiarity = self.vocab_familiarity
+        return [(familiarity[vocab_id], vocab_id, native, romaji)
+                for vocab_id, native, romaji in self.active_vocab
+                if vocab_id in familiarity]
+
+    def sample_question(self, bin_weights):
+        deck = database.draw_deck(self._rows(), bin_weights, 1)
+        return deck[0] if deck else None
+
+    def sample_deck(self, bin_weights, size: int):
+        return database.draw_deck(self._rows(), bin_weights, size)
+
+
+class ProgressCache():
+    """
+    LRU cache of UserProgress by user id, capped by the total number of
+    entries its progress holds rather than by the number of users, since a
+    user's vocab grows with their level.
+    """
+
+    def __init__(self, max_entries: int = 500000):
+        """
+        Arguments:
+            max_entries: total size of the cached progress before the least
+                recently used users are evicted
+        """
+        self.max_entries = max_entries
+        self._users = collections.OrderedDict()
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int):
+        """ Returns the cached UserProgress of a user, or None. """
+        progress = self._users.get(user_id)
+        if progress is None:
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return progress
+
+    def peek(self, user_id: int):
+        """ Returns the cached UserProgress of a user without using it. """
+        return self._users.get(user_id)
+
+    def put(self, user_id: int, progress: UserProgress):
+        """
+        Caches the progress of a user, evicting least recently used users
+        while the cache is over its size.
+
+        Returns:
+            List of the user ids that were evicted
+        """
+        self.discard(user_id)
+        self._users[user_id] = progress
+        self.entries += progress.size()
+        evicted = []
+        while self.entries > self.max_entries and len(self._users) > 1:
+            old_id, old = self._users.popitem(last=False)
+            self.entries -= old.size()
+            self.evictions += 1
+            evicted.append(old_id)
+        return evicted
+
+    def discard(self, user_id: int):
+        """ Drops the progress of a user. """
+        progress = self._users.pop(user_id, None)
+        if progress is not None:
+            self.entries -= progress.size()
+
+    def clear(self):
+        """ Drops every user. """
+        self._users.clear()
+        self.entries = 0
+
+    def __len__(self):
+        return len(self._users)
@@ -0,0 +1,164 @@
+"""
+Checks that the queries issued by Database are served by indexes.
+
+Every Database method used by the cogs is run against a small scratch
+database created through the migrations. The statements they execute are
+captured and passed through EXPLAIN QUERY PLAN, and any full table scan is
+reported. The process exits with status 1 if a scan is found.
+
+Usage:
+    python -m background.query_audit
+"""
+import os
+import sys
+import tempfile
+
+import background.database as database
+
+# Tables that are expected to be read in full. [sets] holds a handful of rows
+# and user_sets lists every one of them. [guilds] is read once at startup by
+# guild_prefixes. [catalog_version] has a single row.
+SCAN_ALLOWED = {'sets', 'guilds', 'catalog_version'}
+
+# Indexes that are walked in order and cut short by a LIMIT, so a scan of
+# them only reads the rows it returns. top_scores reads the leaderboard
+# from user_stats_score.
+ORDERED_INDEXES = {'user_stats_score'}
+
+# Maintenance methods that read whole tables on purpose and are not run.
+SKIPPED = {'catalog', 'rebuild_user_stats', 'rebuild_unfamiliar_counts',
+           'refresh_set_counts', 'close'}
+
+
+def _seed(db: database.Database):
+    db.cur.execute("INSERT INTO 'sets' (set_id, name, total_levels, \
+        unlock_desc) VALUES (1, 'Hiragana Letters', 2, NULL), \
+        (2, 'Katakana Letters', 1, 'Reach level 10 in Hiragana Letters')")
+    vocab_id = 1
+    for set_id, levels in ((1, 2), (2, 1)):
+        for level in range(1, levels + 1):
+            for i in range(3):
+                db.cur.execute("INSERT INTO 'vocab' (vocab_id, char_native, \
+                    romanization, pronunciation) VALUES (?, ?, ?, NULL)",
+                               [vocab_id, f'k{vocab_id}', f'r{vocab_id}'])
+                db.cur.execute("INSERT INTO 'set-to-vocab' (set_id, vocab_id, \
+                    level) VALUES (?, ?, ?)", [set_id, vocab_id, level])
+                vocab_id += 1
+    db.con.commit()
+
+
+def _exercise(db: database.Database):
+    """ Calls every hot Database method once. """
+    user_id = 1
+    db.create_user(user_id)
+    db.user_exists(user_id)
+    db.set_exists(1)
+    db.current_level(user_id, 1)
+    db.active_set_id(user_id)
+    db.familiarity(user_id, 1)
+    db.player_vocab(user_id, 0)
+    db.sample_question(user_id, [1] * 10)
+    db.sample_deck(user_id, [1] * 10, 5)
+    db.due_vocab(user_id, 5)
+    db.user_progress(user_id)
+    db.next_review(user_id)
+    db.familiarities(user_id, [1, 2])
+    db.vocab_familiarities(1, [user_id, 2])
+    db.as_defn_pair(1)
+    db.pronunciation(1)
+    db.response_update(user_id, 1, True)
+    db.apply_answers([(user_id, 1, [True, False])])
+    db.check_level_up(user_id)
+    db.user_sets(user_id)
+    db.total_level(user_id)
+    db.total_vocab(user_id)
+    db.total_times_played(user_id)
+    db.total_times_correct(user_id)
+    db.user_stats(user_id)
+    db.scores([user_id, 2])
+    db.top_scores(10)
+    db.add_guild_member(10, user_id)
+    db.guild_top_scores(10, 10)
+    db.native_to_vocab_id('k1')
+    db.set_name_to_id('hiragana letters')
+    db.set_to_dict(user_id, 1, 0, 9)
+    db.dict_page(user_id, 1, 0, 25)
+    db.set_is_unlocked(user_id, 1)
+    db.unlock_set(user_id, 2)
+    db.activate_set(user_id, 2)
+    db.max_level(1)
+    db.import_guilds({'10': '!'})
+    db.set_guild_prefix(10, '?')
+    db.guild_prefixes()
+    db.remove_guild(10)
+    db.post_shard_command('reload', 'quiz', 'audit')
+    db.shard_commands_since(0)
+    db.last_shard_command_id()
+    db.data_version()
+    db.take_stats_changed()
+    db.catalog_version()
+
+
+def audit(path: str):
+    """
+    Runs the Database methods against a scratch database and explains every
+    statement they execute.
+
+    Arguments:
+        path: location for the scratch database, which must not exist yet
+    Returns:
+        List of (statement, plan detail) pairs for every full table scan
+    """
+    db = database.Database(path)
+    _seed(db)
+    statements = []
+    db.con.set_trace_callback(statements.append)
+    _exercise(db)
+    db.con.set_trace_callback(None)
+
+    scans = []
+    seen = set()
+    for statement in statements:
+        if statement in seen or not statement.lstrip().upper().startswith(
+                ('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+            continue
+        seen.add(statement)
+        for row in db.cur.execute(f'EXPLAIN QUERY PLAN {statement}').fetchall():
+            detail = row[-1]
+            words = detail.replace("'", '').split()
+            if words[0] != 'SCAN' or words[1] == 'CONSTANT':
+                continue
+            table = words[2] if words[1] == 'TABLE' else words[1]
+            if words[-1] in ORDERED_INDEXES and 'LIMIT' in statement.upper():
+                continue
+            # scans of materialized subqueries read temporary results
+            if table not in SCAN_ALLOWED and not table.startswith('('):
+                scans.append((statement, detail))
+    db.close()
+    return scans
+
+
+def untested_methods():
+    """ Returns the public Database methods that the audit does not call. """
+    called = set(_exercise.__code__.co_names)
+    return sorted(name for name, value in vars(database.Database).items()
+                  if callable(value) and not name.startswith('_')
+                  and not isinstance(value, (type, staticmethod))
+                  and name not in called and name not in SKIPPED)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        scans = audit(os.path.join(tmp, 'audit.db'))
+    for statement, detail in scans:
+        print(f'{detail}\n    {" ".join(statement.split())}')
+    missing = untested_methods()
+    if missing:
+        print(f'Not audited: {", ".join(missing)}')
+    if scans or missing:
+        sys.exit(1)
+    print('No full table scans.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import collections
+import time
+
+
+class Limit():
+    """ Rate and burst size of a token bucket. """
+
+    __slots__ = ('rate', 'burst')
+
+    def __init__(self, rate: float, burst: int):
+        """
+        Arguments:
+            rate: tokens added per second
+            burst: most tokens the bucket holds, which is the number of calls
+                allowed at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+
+    def idle_time(self) -> float:
+        """ Returns the seconds an empty bucket takes to fill up. """
+        return self.burst / self.rate
+
+
+class Bucket():
+    """ Tokens left in one bucket, as of its last update. """
+
+    __slots__ = ('tokens', 'updated_at', 'warned')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated_at = now
+        # whether the caller was told about the current rejection streak
+        self.warned = False
+
+    def refill(self, limit: Limit, now: float):
+        self.tokens = min(limit.burst,
+                          self.tokens + (now - self.updated_at) * limit.rate)
+        self.updated_at = now
+
+    def retry_after(self, limit: Limit) -> float:
+        """ Returns the seconds until the bucket holds a whole token. """
+        return max(0.0, (1 - self.tokens) / limit.rate)
+
+
+class RateLimiter():
+    """
+    Token buckets per user and per guild, with limits set per command.
+
+    A call is allowed when both the user's and the guild's bucket for the
+    command hold a token, and then takes one from each. A call that is
+    rejected takes nothing.
+
+    Buckets are kept in an OrderedDict in order of last use. A bucket that
+    has been idle long enough to fill up is the same as no bucket, so it is
+    evicted; at most max_buckets are kept in any case, dropping the least
+    recently used, which at worst lets a user through early.
+    """
+
+    def __init__(self, user_limits, guild_limits=None,
+                 max_buckets: int = 100000):
+        """
+        Arguments:
+            user_limits: dict of command name to the Limit of each user.
+                Commands that are not listed are not limited per user.
+            guild_limits: dict of command name to the Limit of each guild.
+                Commands that are not listed are not limited per guild.
+            max_buckets: most buckets kept in memory
+        """
+        self.user_limits = user_limits
+        self.guild_limits = guild_limits or {}
+        self.max_buckets = max_buckets
+        # ('user' or 'guild', id, command) -> Bucket
+        self._buckets = collections.OrderedDict()
+        self.allowed = 0
+        self.rejected = {'user': 0, 'guild': 0}
+
+    def acquire(self, command: str, user_id: int, guild_id: int = None,
+                now: float = None):
+        """
+        Takes a token for a call of a command.
+
+        Arguments:
+            command: qualified name of the command
+            user_id: Discord id of the caller
+            guild_id: Discord id of the guild the command was used in, or None
+            now: monotonic time of the call. Defaults to now.
+        Returns:
+            None if the call is allowed. Otherwise a triple of (scope, seconds
+            until the call would be allowed, bool of whether this is the first
+            rejection since the bucket last allowed a call), where scope is
+            'user' or 'guild'.
+        """
+        if now is None:
+            now = time.monotonic()
+        try:
+            return self._acquire(command, user_id, guild_id, now)
+        finally:
+            self._evict(now)
+
+    def _acquire(self, command: str, user_id: int, guild_id: int, now: float):
+        checks = [('user', user_id, self.user_limits.get(command))]
+        if guild_id is not None:
+            checks.append(('guild', guild_id, self.guild_limits.get(command)))
+        buckets = []
+        for scope, owner_id, limit in checks:
+            if limit is None:
+                continue
+            key = (scope, owner_id, command)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = Bucket(limit.burst, now)
+            else:
+                self._buckets.move_to_end(key)
+                bucket.refill(limit, now)
+            if bucket.tokens < 1:
+                self.rejected[scope] += 1
+                first = not bucket.warned
+                bucket.warned = True
+                return scope, bucket.retry_after(limit), first
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+            bucket.warned = False
+        self.allowed += 1
+        return None
+
+    def _evict(self, now: float):
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            scope, _, command = key
+            limits = self.user_limits if scope == 'user' else self.guild_limits
+            if len(self._buckets) <= self.max_buckets and \
+                    now - bucket.updated_at < limits[command].idle_time():
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import itertools
+
+
+class AnswerRouter():
+    """
+    Routes incoming messages to the quizzes waiting for them.
+
+    Pending answers are kept in a dict keyed by (channel_id, author_id), so
+    routing a message is a single lookup no matter how many quizzes are
+    running. Timeouts share one timer: deadlines are kept in a heap and only
+    the earliest one is scheduled on the event loop.
+
+    A channel can also have one listener that receives every message in it
+    not claimed by a pending answer, which serves quizzes open to everyone.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.listeners = {}
+        self._deadlines = []
+        self._counter = itertools.count()
+        self._timer = None
+        self._timer_at = None
+        self.routed = 0
+        self.timeouts = 0
+
+    async def wait(self, channel_id: int, author_id: int, timeout: float):
+        """
+        Waits for the next message by an author in a channel.
+
+        Arguments:
+            channel_id: Discord channel id
+            author_id: Discord user id
+            timeout: seconds to wait before giving up
+        Returns:
+            The discord.Message that was routed
+        Raises:
+            asyncio.TimeoutError if no message arrives in time
+        """
+        loop = asyncio.get_running_loop()
+        key = (channel_id, author_id)
+        previous = self.pending.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        future = loop.create_future()
+        self.pending[key] = future
+        deadline = loop.time() + timeout
+        heapq.heappush(self._deadlines,
+                       (deadline, next(self._counter), key, future))
+        if self._timer_at is None or deadline < self._timer_at:
+            self._schedule(loop, deadline)
+        try:
+            return await future
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    def listen(self, channel_id: int, callback):
+        """
+        Sends every unclaimed message in a channel to a callback.
+
+        Arguments:
+            channel_id: Discord channel id
+            callback: function called with each discord.Message
+        Returns:
+            bool of whether the listener was added. Fails if the channel
+            already has one.
+        """
+        if channel_id in self.listeners:
+            return False
+        self.listeners[channel_id] = callback
+        return True
+
+    def unlisten(self, channel_id: int):
+        """ Removes the listener of a channel. """
+        self.listeners.pop(channel_id, None)
+
+    def route(self, message) -> bool:
+        """
+        Hands a message to the quiz waiting for it.
+
+        Returns:
+            bool of whether a quiz was waiting for the message
+        """
+        key = (message.channel.id, message.author.id)
+        future = self.pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(message)
+            self.routed += 1
+            return True
+        callback = self.listeners.get(message.channel.id)
+        if callback is None:
+            return False
+        callback(message)
+        self.routed += 1
+        return True
+
+    def _schedule(self, loop, deadline: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_at(deadline, self._expire, loop)
+        self._timer_at = deadline
+
+    def _expire(self, loop):
+        self._timer = None
+        self._timer_at = None
+        now = loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, key, future = heapq.heappop(self._deadlines)
+            if future.done():
+                continue
+            future.set_exception(asyncio.TimeoutError())
+            self.timeouts += 1
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        # drop entries that were answered before their deadline
+        while self._deadlines and self._deadlines[0][3].done():
+            heapq.heappop(self._deadlines)
+        if self._deadlines:
+            self._schedule(loop, self._deadlines[0][0])
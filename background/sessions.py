@@ -0,0 +1,94 @@
+import time
+
+
+class Session():
+    """ State of one user's running quiz. """
+
+    __slots__ = ('user_id', 'channel_id', 'started_at', 'expires_at',
+                 'vocab_id')
+
+    def __init__(self, user_id: int, channel_id: int, timeout: float):
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + timeout
+        self.vocab_id = None
+
+    def expired(self, now: float = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        return now >= self.expires_at
+
+
+class SessionManager():
+    """
+    Tracks running quizzes, at most one per user.
+
+    Sessions are kept in a dict keyed by user id. A session that is not ended
+    within its timeout is treated as abandoned, so a quiz that failed without
+    cleaning up never locks its user out for long.
+    """
+
+    def __init__(self, timeout: float = 60.0):
+        """
+        Arguments:
+            timeout: seconds after which an unfinished session expires
+        """
+        self.timeout = timeout
+        self.sessions = {}
+        self.expired_total = 0
+
+    def start(self, user_id: int, channel_id: int):
+        """
+        Starts a session for the user.
+
+        Returns:
+            The new Session, or None if the user already has an active one
+        """
+        session = self.sessions.get(user_id)
+        if session is not None:
+            if not session.expired():
+                return None
+            self.expired_total += 1
+        session = Session(user_id, channel_id, self.timeout)
+        self.sessions[user_id] = session
+        return session
+
+    def get(self, user_id: int):
+        """ Returns the user's active Session, or None. """
+        session = self.sessions.get(user_id)
+        if session is None or session.expired():
+            return None
+        return session
+
+    def touch(self, session: Session, timeout: float = None):
+        """ Pushes back the expiry of a session that is still making progress. """
+        if timeout is None:
+            timeout = self.timeout
+        session.expires_at = time.monotonic() + timeout
+
+    def end(self, session: Session):
+        """
+        Ends a session. A session that has already been replaced is left
+        alone.
+        """
+        if self.sessions.get(session.user_id) is session:
+            del self.sessions[session.user_id]
+
+    def expire(self) -> int:
+        """ Removes every expired session and returns how many there were. """
+        now = time.monotonic()
+        expired = [user_id for user_id, session in self.sessions.items()
+                   if session.expired(now)]
+        for user_id in expired:
+            del self.sessions[user_id]
+        self.expired_total += len(expired)
+        return len(expired)
+
+    @property
+    def active(self) -> int:
+        """
+        Number of sessions that have not ended, including expired ones that
+        have not been swept yet.
+        """
+        return len(self.sessions)
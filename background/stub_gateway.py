@@ -0,0 +1,277 @@
+"""
+Stands in for the Discord gateway and REST API so sharded bot processes can
+be run and tested locally.
+
+The stub serves the few REST routes the bot uses on startup, accepts gateway
+connections for any number of shards and gives each shard the guilds Discord
+would assign to it, using (guild_id >> 22) % shard_count. Messages are
+injected over HTTP and delivered to the shard that owns their guild. Messages
+sent by the bot are recorded and can be read back.
+
+Usage:
+    python -m background.stub_gateway --port 8765 --guilds 8
+    DISCORD_TOKEN=stub python bot.py --shard-count 4 --processes 2 \\
+        --api-url http://127.0.0.1:8765
+
+    curl -X POST localhost:8765/stub/messages \\
+        -d '{"guild": 3, "author_id": 1, "content": "!quiz"}'
+    curl localhost:8765/stub/sent
+
+The "guild" field of an injected message is an index into the stub's guilds.
+Each guild has a single text channel, so the channel is implied.
+"""
+import argparse
+import datetime
+import itertools
+import json
+
+from aiohttp import web
+
+BOT_ID = 900000000000000001
+HEARTBEAT_INTERVAL = 41250
+# discord.py and discord_ui use different versions of the REST API.
+API = '/api/{version:v[0-9]+}'
+
+
+def _user(user_id: int, name: str = None, bot: bool = False):
+    return {
+        'id': str(user_id),
+        'username': name or f'user{user_id}',
+        'discriminator': '0001',
+        'avatar': None,
+        'bot': bot,
+    }
+
+
+def _json(data) -> web.Response:
+    # discord.py only parses responses whose content type is exactly
+    # application/json, without a charset.
+    return web.Response(body=json.dumps(data).encode(),
+                        content_type='application/json')
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class StubGateway():
+    """
+    In-process fake of the parts of Discord the bot talks to.
+
+    Attributes:
+        guilds: list of guild ids, one text channel each at guild_id + 1
+        shards: dict of (shard_id, shard_count) to the open websocket
+        sent: list of message payloads created by the bot
+    """
+
+    def __init__(self, guilds: int, owner_id: int):
+        """
+        Arguments:
+            guilds: number of guilds to create
+            owner_id: user id reported as the owner of the application
+        """
+        # Guild ids carry their index in the timestamp bits, so they are
+        # dealt evenly between shards.
+        self.guilds = [(index << 22) + 1000 for index in range(guilds)]
+        self.owner_id = owner_id
+        self.shards = {}
+        self.sent = []
+        self._ids = itertools.count(10 ** 17)
+        self._sequence = itertools.count(1)
+        self.url = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get('/ws', self.gateway),
+            web.get(API + '/gateway', self.get_gateway),
+            web.get(API + '/gateway/bot', self.get_gateway),
+            web.get(API + '/users/@me', self.get_me),
+            web.get(API + '/oauth2/applications/@me', self.get_application),
+            web.post(API + '/channels/{channel_id}/messages',
+                     self.create_message),
+            web.route('*', API + '/{path:.*}', self.fallback),
+            web.post('/stub/messages', self.inject_message),
+            web.get('/stub/sent', self.get_sent),
+            web.get('/stub/shards', self.get_shards),
+        ])
+        return app
+
+    def shard_of(self, guild_id: int, shard_count: int) -> int:
+        return (guild_id >> 22) % shard_count
+
+    def _guild(self, guild_id: int):
+        channel_id = guild_id + 1
+        return {
+            'id': str(guild_id),
+            'name': f'Guild {guild_id}',
+            'icon': None,
+            'owner_id': str(self.owner_id),
+            'region': 'us-west',
+            'afk_timeout': 300,
+            'verification_level': 0,
+            'default_message_notifications': 0,
+            'explicit_content_filter': 0,
+            'mfa_level': 0,
+            'features': [],
+            'member_count': 1,
+            'large': False,
+            'unavailable': False,
+            'roles': [{
+                'id': str(guild_id), 'name': '@everyone', 'permissions': '2147483647',
+                'position': 0, 'color': 0, 'hoist': False, 'managed': False,
+                'mentionable': False,
+            }],
+            'channels': [{
+                'id': str(channel_id), 'type': 0, 'name': 'general',
+                'position': 0, 'permission_overwrites': [], 'nsfw': False,
+                'topic': None, 'rate_limit_per_user': 0, 'parent_id': None,
+            }],
+            'members': [{
+                'user': _user(BOT_ID, 'stub-bot', bot=True), 'roles': [],
+                'joined_at': _now(), 'deaf': False, 'mute': False,
+            }],
+            'emojis': [],
+            'voice_states': [],
+            'presences': [],
+        }
+
+    def _message(self, channel_id: int, guild_id: int, author, content: str,
+                  extra=None):
+        message = {
+            'id': str(next(self._ids)),
+            'channel_id': str(channel_id),
+            'author': author,
+            'content': content or '',
+            'timestamp': _now(),
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0,
+        }
+        if guild_id != None:
+            message['guild_id'] = str(guild_id)
+            message['member'] = {'roles': [], 'joined_at': _now(),
+                                 'deaf': False, 'mute': False}
+        message.update(extra or {})
+        return message
+
+    async def _dispatch(self, ws, event: str, data):
+        await ws.send_str(json.dumps(
+            {'op': 0, 't': event, 's': next(self._sequence), 'd': data}))
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps(
+            {'op': 10, 't': None, 's': None,
+             'd': {'heartbeat_interval': HEARTBEAT_INTERVAL}}))
+        key = None
+        try:
+            async for msg in ws:
+                payload = json.loads(msg.data)
+                if payload['op'] == 1:
+                    await ws.send_str(json.dumps(
+                        {'op': 11, 't': None, 's': None, 'd': None}))
+                elif payload['op'] == 2:
+                    shard_id, shard_count = payload['d'].get('shard', (0, 1))
+                    key = (shard_id, shard_count)
+                    self.shards[key] = ws
+                    guilds = [guild_id for guild_id in self.guilds
+                              if self.shard_of(guild_id, shard_count) == shard_id]
+                    await self._dispatch(ws, 'READY', {
+                        'v': 6,
+                        'user': _user(BOT_ID, 'stub-bot', bot=True),
+                        'guilds': [{'id': str(guild_id), 'unavailable': True}
+                                   for guild_id in guilds],
+                        'session_id': f'stub-{shard_id}',
+                        'shard': [shard_id, shard_count],
+                        'private_channels': [],
+                        'relationships': [],
+                    })
+                    for guild_id in guilds:
+                        await self._dispatch(ws, 'GUILD_CREATE',
+                                             self._guild(guild_id))
+        finally:
+            if key != None and self.shards.get(key) is ws:
+                del self.shards[key]
+        return ws
+
+    async def get_gateway(self, request):
+        return _json({
+            'url': f'{self.url}/ws', 'shards': 1,
+            'session_start_limit': {'total': 1000, 'remaining': 1000,
+                                    'reset_after': 0, 'max_concurrency': 1}})
+
+    async def get_me(self, request):
+        return _json(_user(BOT_ID, 'stub-bot', bot=True))
+
+    async def get_application(self, request):
+        return _json({
+            'id': str(BOT_ID), 'name': 'stub-bot', 'description': '',
+            'icon': None, 'rpc_origins': None, 'bot_public': True,
+            'bot_require_code_grant': False, 'summary': '', 'verify_key': '',
+            'owner': _user(self.owner_id)})
+
+    async def create_message(self, request):
+        channel_id = int(request.match_info['channel_id'])
+        if request.content_type == 'application/json':
+            body = await request.json()
+        else:  # multipart requests carry the JSON in a field
+            body = json.loads((await request.post()).get('payload_json', '{}'))
+        message = self._message(
+            channel_id, channel_id - 1, _user(BOT_ID, 'stub-bot', bot=True),
+            body.get('content'),
+            {'embeds': [body['embed']] if body.get('embed') else [],
+             'components': body.get('components', [])})
+        self.sent.append(message)
+        return _json(message)
+
+    async def fallback(self, request):
+        if request.method == 'GET':
+            return _json([])
+        return _json({})
+
+    async def inject_message(self, request):
+        body = await request.json()
+        guild_id = self.guilds[body['guild']]
+        matching = [(key, ws) for key, ws in self.shards.items()
+                    if self.shard_of(guild_id, key[1]) == key[0]]
+        if not matching:
+            raise web.HTTPServiceUnavailable(
+                text=f'No shard is connected for guild {guild_id}')
+        (shard_id, _), ws = matching[0]
+        author_id = body.get('author_id', self.owner_id)
+        await self._dispatch(ws, 'MESSAGE_CREATE', self._message(
+            guild_id + 1, guild_id, _user(author_id), body['content']))
+        return _json({'shard_id': shard_id, 'guild_id': guild_id})
+
+    async def get_sent(self, request):
+        after = int(request.query.get('after', 0))
+        return _json(self.sent[after:])
+
+    async def get_shards(self, request):
+        return _json(sorted(list(key) for key in self.shards))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--guilds', type=int, default=8)
+    parser.add_argument('--owner-id', type=int, default=1,
+                        help='user id that may run the owner commands')
+    args = parser.parse_args()
+
+    stub = StubGateway(args.guilds, args.owner_id)
+    stub.url = f'http://{args.host}:{args.port}'
+    web.run_app(stub.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Benchmarks the Database call sequences behind the quiz, profile, dictionary
+and sets commands against a synthetic database.
+
+A temporary SQLite file is filled with the requested number of users, sets
+and vocab, then each scenario is run for a number of iterations with a random
+user per iteration. Throughput and p50/p99 latency are reported per scenario.
+
+Usage:
+    python -m benchmarks.database --users 10000 --save baseline.json
+    python -m benchmarks.database --users 10000 --check baseline.json
+
+With --check, the process exits with status 1 if any scenario is slower than
+the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import background.database as database
+
+BIN_WEIGHTS = (20, 13, 13, 13, 12, 5, 5, 5, 5, 8)
+
+
+def build(path: str, users: int, sets: int, levels: int, vocab_per_level: int,
+          seed: int = 0):
+    """
+    Creates a synthetic database.
+
+    The raw tables are filled under the base schema, then the remaining
+    migrations run and backfill their derived data, as they would for a real
+    database being upgraded.
+
+    Arguments:
+        path: location of the new database
+        users: number of users
+        sets: number of sets
+        levels: number of levels in each set
+        vocab_per_level: number of vocab in each level of a set
+        seed: random seed for the generated progress
+    """
+    rng = random.Random(seed)
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    database.MIGRATIONS[0](cur)
+    cur.execute('PRAGMA user_version = 1')
+
+    cur.executemany(
+        "INSERT INTO 'sets' (set_id, name, total_levels) VALUES (?, ?, ?)",
+        [(set_id, f'Set {set_id}', levels) for set_id in range(1, sets + 1)])
+    set_vocab = {}
+    vocab_rows = []
+    vocab_id = 1
+    for set_id in range(1, sets + 1):
+        for level in range(1, levels + 1):
+            for _ in range(vocab_per_level):
+                vocab_rows.append((vocab_id, f'v{vocab_id}', f'r{vocab_id}'))
+                set_vocab.setdefault(set_id, []).append((vocab_id, level))
+                vocab_id += 1
+    cur.executemany("INSERT INTO 'vocab' (vocab_id, char_native, \
+        romanization) VALUES (?, ?, ?)", vocab_rows)
+    cur.executemany(
+        "INSERT INTO 'set-to-vocab' (set_id, vocab_id, level) VALUES (?, ?, ?)",
+        [(set_id, vocab_id, level) for set_id, entries in set_vocab.items()
+         for vocab_id, level in entries])
+
+    for user_id in range(1, users + 1):
+        unlocked = rng.randint(1, sets)
+        cur.execute("INSERT INTO 'users' (user_id, active_set_id) VALUES (?, ?)",
+                    [user_id, rng.randint(1, unlocked)])
+        user_vocab = []
+        for set_id in range(1, unlocked + 1):
+            current_level = rng.randint(1, levels)
+            cur.execute("INSERT INTO 'unlocked-sets' (user_id, set_id, \
+                current_level) VALUES (?, ?, ?)", [user_id, set_id, current_level])
+            for vocab_id, level in set_vocab[set_id]:
+                if level > current_level:
+                    continue
+                shown = rng.randint(0, 30)
+                user_vocab.append((user_id, vocab_id, rng.randint(0, shown),
+                                   shown, rng.randint(0, 9)))
+        cur.executemany("INSERT INTO 'user-to-vocab' (user_id, vocab_id, \
+            times_correct, times_shown, familiarity) VALUES (?, ?, ?, ?, ?)",
+                        user_vocab)
+    con.commit()
+    con.close()
+    database.Database(path).close()
+
+
+def quiz_turn(db: database.Database, user_id: int):
+    if not db.user_exists(user_id):
+        return
+    question = db.sample_question(user_id, BIN_WEIGHTS)
+    if question != None:
+        db.response_update(user_id, question[0], random.random() < 0.7)
+        db.check_level_up(user_id)
+
+
+def profile(db: database.Database, user_id: int):
+    db.user_stats(user_id)
+
+
+def dictionary(db: database.Database, user_id: int):
+    set_id = db.active_set_id(user_id)
+    if db.set_is_unlocked(user_id, set_id):
+        db.dict_page(user_id, set_id, 0, 25)
+
+
+def sets(db: database.Database, user_id: int):
+    db.user_sets(user_id)
+    db.active_set_id(user_id)
+
+
+SCENARIOS = {
+    'quiz_turn': quiz_turn,
+    'profile': profile,
+    'dictionary': dictionary,
+    'sets': sets,
+}
+
+
+def percentile(samples, fraction: float) -> float:
+    """ Returns the sample at the given fraction of a sorted list. """
+    index = min(int(fraction * len(samples)), len(samples) - 1)
+    return samples[index]
+
+
+def run(db: database.Database, users: int, iterations: int, seed: int = 0,
+        warmup: int = 100):
+    """
+    Runs every scenario and returns a dict of their results.
+
+    Arguments:
+        db: database to benchmark
+        users: number of users in the database
+        iterations: number of timed runs of each scenario
+        seed: random seed for the chosen users
+        warmup: number of untimed runs of each scenario before timing
+    """
+    results = {}
+    for name, scenario in SCENARIOS.items():
+        rng = random.Random(seed)
+        for _ in range(warmup):
+            scenario(db, rng.randint(1, users))
+        samples = []
+        for _ in range(iterations):
+            user_id = rng.randint(1, users)
+            start = time.perf_counter()
+            scenario(db, user_id)
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results[name] = {
+            'ops_per_sec': len(samples) / sum(samples),
+            'p50_ms': percentile(samples, 0.50) * 1000,
+            'p99_ms': percentile(samples, 0.99) * 1000,
+        }
+    return results
+
+
+def regressions(results, baseline, tolerance: float):
+    """
+    Returns a list of messages for every scenario that is slower than the
+    baseline by more than the tolerance.
+    """
+    messages = []
+    for name, base in baseline['results'].items():
+        current = results.get(name)
+        if current == None:
+            continue
+        if current['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            messages.append(f"{name}: {current['ops_per_sec']:.0f} ops/s, "
+                            f"baseline {base['ops_per_sec']:.0f} ops/s")
+        if current['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            messages.append(f"{name}: p99 {current['p99_ms']:.3f} ms, "
+                            f"baseline {base['p99_ms']:.3f} ms")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--sets', type=int, default=2)
+    parser.add_argument('--levels', type=int, default=10)
+    parser.add_argument('--vocab-per-level', type=int, default=5)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a JSON baseline')
+    parser.add_argument('--check', metavar='FILE',
+                        help='compare the results against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in
+              ('users', 'sets', 'levels', 'vocab_per_level', 'iterations')}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        build(path, args.users, args.sets, args.levels, args.vocab_per_level,
+              args.seed)
+        db = database.Database(path)
+        results = run(db, args.users, args.iterations, args.seed, args.warmup)
+        db.close()
+
+    for name, result in results.items():
+        print(f"{name:<12} {result['ops_per_sec']:>10.0f} ops/s  "
+              f"p50 {result['p50_ms']:.3f} ms  p99 {result['p99_ms']:.3f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=4)
+    if args.check:
+        with open(args.check, 'r') as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print('Warning: baseline was recorded with a different config.')
+        failures = regressions(results, baseline, args.tolerance)
+        for message in failures:
+            print(f'Regression - {message}')
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Measures how long the bot takes to start.
+
+Two measurements are taken. The import audit runs the modules imported at
+startup under python -X importtime and reports the packages that take the
+most time to import. The ready benchmark starts bot.py against the stub
+gateway and a synthetic database, and times process start to on_ready.
+The first ready run builds the catalog snapshot; later runs load it.
+discord.py waits GUILD_READY_TIMEOUT seconds after the last guild arrives
+before on_ready, so the benchmark sets it low to time the bot's own work.
+
+Usage:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 5 --save baseline.json
+    python -m benchmarks.startup --check baseline.json
+
+With --check, the process exits with status 1 if start to on_ready is slower
+than the baseline by more than the tolerance. It also exits with status 1 if
+a module in LAZY_MODULES is imported at startup.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchmarks.database as bench_database
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules bot.py imports before it connects, including every cog.
+STARTUP_MODULES = (
+    'discord.ext.commands', 'discord.ext.tasks', 'dotenv',
+    'background.async_database', 'background.guild_settings',
+    'background.ratelimit', 'background.log_pipeline',
+    'cogs.general', 'cogs.misc', 'cogs.quiz',
+)
+
+# Modules that must only be imported when a command needs them.
+LAZY_MODULES = ('numpy',)
+
+
+def import_times(modules=STARTUP_MODULES):
+    """
+    Imports modules in a fresh interpreter under -X importtime.
+
+    Returns:
+        List of (module, self microseconds, cumulative microseconds) in
+        import order
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         f"import {', '.join(modules)}"],
+        cwd=ROOT, capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def by_package(entries):
+    """ Returns a dict of top level package to its total import time in us. """
+    totals = {}
+    for name, self_us, _ in entries:
+        package = name.split('.')[0]
+        totals[package] = totals.get(package, 0) + self_us
+    return totals
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Stub gateway did not start on port {port}')
+
+
+def time_to_ready(workdir: str, env, timeout: float = 60.0) -> float:
+    """
+    Starts bot.py and returns the seconds until it reports on_ready.
+
+    Arguments:
+        workdir: working directory of the bot, holding cogs and data
+        env: environment of the bot process
+        timeout: seconds to wait before giving up
+    """
+    start = time.perf_counter()
+    bot = subprocess.Popen(
+        [sys.executable, '-u', os.path.join(ROOT, 'bot.py')], cwd=workdir,
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        deadline = time.monotonic() + timeout
+        for line in bot.stdout:
+            if 'is online!' in line:
+                return time.perf_counter() - start
+            if time.monotonic() > deadline:
+                break
+        raise RuntimeError('bot.py exited or timed out before on_ready')
+    finally:
+        bot.terminate()
+        bot.wait()
+
+
+def run_ready(runs: int, users: int):
+    """
+    Times start to on_ready of bot.py against the stub gateway.
+
+    Returns:
+        List of seconds per run. The first run starts without a catalog
+        snapshot.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        os.symlink(os.path.join(ROOT, 'cogs'), os.path.join(tmp, 'cogs'))
+        os.mkdir(os.path.join(tmp, 'data'))
+        db_path = os.path.join(tmp, 'bench.db')
+        bench_database.build(db_path, users, sets=2, levels=10,
+                             vocab_per_level=5)
+        port = free_port()
+        stub = subprocess.Popen(
+            [sys.executable, '-m', 'background.stub_gateway',
+             '--port', str(port)], cwd=ROOT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            env = dict(os.environ, DB_LOC=db_path, DISCORD_TOKEN='stub',
+                       BOT_PREFIX='!', DISCORD_API_URL=f'http://127.0.0.1:{port}',
+                       GUILD_READY_TIMEOUT='0.05')
+            return [time_to_ready(tmp, env) for _ in range(runs)]
+        finally:
+            stub.terminate()
+            stub.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of packages shown in the import audit')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results as a JSON baseline')
+    parser.add_argument('--check', metavar='FILE',
+                        help='compare the results against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    args = parser.parse_args()
+    failures = []
+
+    entries = import_times()
+    total_us = sum(self_us for _, self_us, _ in entries)
+    print(f'Imports at startup: {len(entries)} modules, {total_us / 1000:.1f} ms')
+    totals = sorted(by_package(entries).items(), key=lambda item: item[1],
+                    reverse=True)
+    for package, package_us in totals[:args.top]:
+        print(f'  {package:<24} {package_us / 1000:>8.1f} ms')
+    imported = {name for name, _, _ in entries}
+    for module in LAZY_MODULES:
+        if module in imported:
+            failures.append(f'{module} is imported at startup')
+
+    samples = run_ready(args.runs, args.users)
+    warm = samples[1:] or samples
+    results = {
+        'imports_ms': total_us / 1000,
+        'cold_ready_ms': samples[0] * 1000,
+        'warm_ready_ms': statistics.median(warm) * 1000,
+    }
+    print(f"Start to on_ready: {results['cold_ready_ms']:.0f} ms without a "
+          f"catalog snapshot, {results['warm_ready_ms']:.0f} ms median with one")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'results': results}, f, indent=4)
+    if args.check:
+        with open(args.check, 'r') as f:
+            baseline = json.load(f)['results']
+        limit = baseline['warm_ready_ms'] * (1 + args.tolerance)
+        if results['warm_ready_ms'] > limit:
+            failures.append(f"on_ready took {results['warm_ready_ms']:.0f} ms, "
+                            f"baseline {baseline['warm_ready_ms']:.0f} ms")
+    for message in failures:
+        print(f'Regression - {message}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
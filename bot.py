@@ -1,60 +1,373 @@
 # bot.py
 import discord
-import json
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 import os
+import sys
+import math
+import time
+import socket
+import asyncio
+import argparse
 import logging
+import background.async_database as async_database
+import background.guild_settings as guild_settings
+import background.ratelimit as ratelimit
+import background.log_pipeline as log_pipeline
+import background.error_tracker as error_tracker
+from background.metrics import REGISTRY
 from dotenv import load_dotenv
 
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(
-    filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
 DEFAULT_PREFIX = os.getenv('BOT_PREFIX')
 STATUS = os.getenv('BOT_STATUS_DESC')
+METRICS_FILE = os.getenv('METRICS_FILE', 'data/metrics.prom')
+SHARD_COUNT = os.getenv('SHARD_COUNT')
+SHARD_IDS = os.getenv('SHARD_IDS')
+API_URL = os.getenv('DISCORD_API_URL')
+# Seconds on_ready waits for more guilds after the last one arrived.
+GUILD_READY_TIMEOUT = float(os.getenv('GUILD_READY_TIMEOUT', 2))
+# Seconds between checks for owner commands issued by other bot processes.
+SHARD_POLL_INTERVAL = float(os.getenv('SHARD_POLL_INTERVAL', 2))
+LOG_FILE = os.getenv('LOG_FILE', 'discord.log')
+ERROR_FILE = os.getenv('ERROR_FILE', 'err.log')
+# Seconds between writes of newly captured errors to ERROR_FILE.
+ERROR_SAVE_INTERVAL = float(os.getenv('ERROR_SAVE_INTERVAL', 10))
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 2 ** 20))
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Level of each logger, and the fraction of debug records kept per logger.
+# Every gateway event is logged at debug level by discord.gateway.
+LOG_LEVELS = log_pipeline.parse_logger_map(
+    os.getenv('LOG_LEVELS', 'discord=DEBUG'), log_pipeline.level)
+LOG_SAMPLE = log_pipeline.parse_logger_map(
+    os.getenv('LOG_SAMPLE', 'discord.gateway=0.01'), float)
+# Scales every rate limit, such as 2 to allow twice as many commands.
+RATE_LIMIT_SCALE = float(os.getenv('RATE_LIMIT_SCALE', 1))
+
+
+def rate(calls: int, seconds: float):
+    """ Returns a Limit of a burst of calls that refills over seconds. """
+    return ratelimit.Limit(calls * RATE_LIMIT_SCALE / seconds,
+                           calls * RATE_LIMIT_SCALE)
+
+
+# Limits of the commands that read or write the database, per user and per
+# guild. Owner commands are never limited.
+USER_RATE_LIMITS = {
+    'quiz': rate(4, 20), 'review': rate(4, 20), 'race': rate(2, 30),
+    'profile': rate(5, 30), 'dictionary': rate(5, 30), 'sets': rate(5, 30),
+    'leaderboard': rate(3, 30), 'unlock': rate(3, 30),
+    'activate': rate(5, 30), 'changeprefix': rate(2, 60),
+}
+GUILD_RATE_LIMITS = {
+    'quiz': rate(60, 20), 'review': rate(60, 20), 'race': rate(6, 30),
+    'profile': rate(40, 30), 'dictionary': rate(40, 30), 'sets': rate(40, 30),
+    'leaderboard': rate(10, 30),
+}
+
+
+def shard_list(value: str):
+    return [int(shard_id) for shard_id in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs the bot, or a group of its shards.')
+    parser.add_argument('--shard-count', type=int,
+                        default=int(SHARD_COUNT) if SHARD_COUNT else None,
+                        help='total number of shards across every process')
+    parser.add_argument('--shard-ids', type=shard_list,
+                        default=shard_list(SHARD_IDS) if SHARD_IDS else None,
+                        help='comma separated shards run by this process, '
+                        'every shard by default')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='split the shards between this many processes')
+    parser.add_argument('--api-url', default=API_URL,
+                        help='base URL of the Discord API, such as the one '
+                        'of background.stub_gateway')
+    args = parser.parse_args()
+    if args.shard_count == None and (args.shard_ids or args.processes > 1):
+        parser.error('--shard-ids and --processes require --shard-count')
+    return args
+
+
+def launch_processes(args) -> int:
+    """
+    Runs the shards in several child processes and waits for them to exit.
+
+    Shards are dealt to the processes in turn. Every process opens the same
+    database, which they coordinate through.
+
+    Returns:
+        int of the highest exit status of the children
+    """
+    import subprocess
+    shard_ids = args.shard_ids or list(range(args.shard_count))
+    children = []
+    for number in range(min(args.processes, len(shard_ids))):
+        group = shard_ids[number::args.processes]
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--shard-count', str(args.shard_count),
+                   '--shard-ids', ','.join(map(str, group))]
+        if args.api_url != None:
+            command += ['--api-url', args.api_url]
+        children.append(subprocess.Popen(command))
+    try:
+        return max(child.wait() for child in children)
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+        return max(child.wait() for child in children)
+
+
+def process_file(path: str) -> str:
+    """
+    Returns the path with this process' shards appended to the file name,
+    so processes running side by side do not overwrite each other's files.
+    """
+    if args.shard_ids == None:
+        return path
+    base, extension = os.path.splitext(path)
+    shards = '-'.join(map(str, args.shard_ids))
+    return f'{base}-shard{shards}{extension}'
+
+
+args = parse_args()
+if args.processes > 1:
+    sys.exit(launch_processes(args))
+if args.api_url != None:
+    import discord_ui.http
+    discord.http.Route.BASE = f'{args.api_url}/api/v7'
+    # discord_ui sends messages with components through its own routes
+    discord_ui.http.BetterRoute.BASE = f'{args.api_url}/api/v9'
+
+logger = logging.getLogger('discord')
+logs = log_pipeline.LogPipeline(
+    process_file(LOG_FILE), max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+    queue_size=LOG_QUEUE_SIZE, sample_rates=LOG_SAMPLE,
+    formatter=logging.Formatter(
+        '%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+for name, log_level in LOG_LEVELS.items():
+    logging.getLogger(name).setLevel(log_level)
+logs.attach(logger)
+logs.start()
+
+# Identifies this process in the owner commands it shares with the others.
+PROCESS_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+# Shared by the bot and its cogs, so every write goes through one connection.
+db = async_database.AsyncDatabase()
+settings = guild_settings.GuildSettings(db, DEFAULT_PREFIX)
+limiter = ratelimit.RateLimiter(USER_RATE_LIMITS, GUILD_RATE_LIMITS)
+errors = error_tracker.ErrorTracker(process_file(ERROR_FILE))
+# Id of the newest owner command this process has seen.
+last_command_id = 0
 
 
 def get_prefix(client, message):
-    with open('data/guilds.json', 'r') as f:
-        guilds = json.load(f)
-    return guilds[str(message.guild.id)]['prefix']
+    if message.guild is None:
+        return DEFAULT_PREFIX
+    return settings.prefix(message.guild.id)
+
+
+if args.shard_count == None:
+    client = commands.Bot(command_prefix=get_prefix, case_insensitive=True,
+                          guild_ready_timeout=GUILD_READY_TIMEOUT)
+else:
+    client = commands.AutoShardedBot(
+        command_prefix=get_prefix, case_insensitive=True,
+        guild_ready_timeout=GUILD_READY_TIMEOUT,
+        shard_count=args.shard_count, shard_ids=args.shard_ids)
+client.db = db
+
+
+class RateLimited(commands.CheckFailure):
+    """ Raised when a command is used faster than its rate limit. """
+
+    def __init__(self, scope: str, retry_after: float, first: bool):
+        super().__init__(f'Rate limited per {scope} for {retry_after:.1f}s')
+        self.scope = scope
+        self.retry_after = retry_after
+        self.first = first
+
+
+@client.check
+async def rate_limit(ctx):
+    """
+    Rejects commands used too often by a user or in a guild, before they
+    reach the database.
+    """
+    name = ctx.command.qualified_name
+    if name not in USER_RATE_LIMITS and name not in GUILD_RATE_LIMITS:
+        return True
+    # the help command runs the checks of every command it lists
+    if client.get_command(ctx.invoked_with) is not ctx.command:
+        return True
+    if await client.is_owner(ctx.author):
+        return True
+    guild_id = ctx.guild.id if ctx.guild is not None else None
+    rejection = limiter.acquire(name, ctx.author.id, guild_id)
+    if rejection is None:
+        return True
+    scope, retry_after, first = rejection
+    REGISTRY.inc(f'rate_limited_{scope}')
+    REGISTRY.inc(f'rate_limited_command_{name}')
+    raise RateLimited(scope, retry_after, first)
 
 
-client = commands.Bot(command_prefix=get_prefix, case_insensitive=True)
+@client.event
+async def on_command_error(ctx, error):
+    if isinstance(error, RateLimited):
+        # only the first rejection is answered, so spamming a command does
+        # not turn into spamming the channel
+        if error.first:
+            who = 'You are' if error.scope == 'user' else 'This server is'
+            await ctx.send(f':hourglass: {who} using `{ctx.command.name}` too '
+                           f'fast. Try again in {math.ceil(error.retry_after)}s.')
+        return
+    # error handlers of commands set error_handled when they answered
+    if getattr(ctx, 'error_handled', False):
+        return
+    if isinstance(error, commands.CommandInvokeError):
+        capture_error(error.original, f'command {ctx.command.qualified_name}')
+        return
+    await commands.Bot.on_command_error(client, ctx, error)
+
+
+def capture_error(exc: BaseException, context: str):
+    """
+    Records an unhandled error, to be saved with the next batch, and logs
+    its traceback.
+    """
+    fingerprint = errors.capture(exc, context)
+    logger.error(f'Unhandled error in {context} ({fingerprint})', exc_info=exc)
+    REGISTRY.inc('errors')
+
+
+@client.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+
+
+@client.after_invoke
+async def record_command_latency(ctx):
+    REGISTRY.observe('command', ctx.command.qualified_name,
+                     time.perf_counter() - ctx.started_at)
+
+
+@tasks.loop(seconds=15)
+async def export_metrics():
+    REGISTRY.set_gauge('prefix_cache_hits', settings.hits)
+    REGISTRY.set_gauge('guilds', len(client.guilds))
+    REGISTRY.set_gauge('db_commits', db.commits)
+    quiz = client.get_cog('Quiz')
+    if quiz is not None:
+        REGISTRY.set_gauge('answers_routed', quiz.router.routed)
+        REGISTRY.set_gauge('answer_timeouts', quiz.router.timeouts)
+    REGISTRY.set_gauge('rate_limit_buckets', len(limiter))
+    REGISTRY.set_gauge('rate_limit_allowed', limiter.allowed)
+    for scope, rejected in limiter.rejected.items():
+        REGISTRY.set_gauge(f'rate_limit_rejected_{scope}', rejected)
+    REGISTRY.set_gauge('log_records_dropped', logs.dropped)
+    REGISTRY.set_gauge('log_records_sampled_out', logs.sampler.sampled_out)
+    REGISTRY.set_gauge('log_queue_size', logs.queue.qsize())
+    REGISTRY.set_gauge('error_fingerprints', len(errors.groups))
+    REGISTRY.set_gauge('progress_cache_hits', db.progress.hits)
+    REGISTRY.set_gauge('progress_cache_misses', db.progress.misses)
+    REGISTRY.set_gauge('progress_cache_users', len(db.progress))
+    REGISTRY.set_gauge('progress_cache_entries', db.progress.entries)
+    REGISTRY.set_gauge('progress_cache_evictions', db.progress.evictions)
+    contents = REGISTRY.render()
+    await asyncio.get_running_loop().run_in_executor(
+        None, REGISTRY.write, process_file(METRICS_FILE), contents)
+
+
+async def broadcast(command: str, argument: str = None):
+    """ Queues an owner command for every other bot process. """
+    await db.post_shard_command(command, argument, PROCESS_ID)
+
+
+async def run_owner_command(command: str, argument: str = None):
+    """ Carries out an owner command that another bot process issued. """
+    if command == 'load':
+        client.load_extension(f'cogs.{argument}')
+    elif command == 'unload':
+        client.unload_extension(f'cogs.{argument}')
+    elif command == 'reload':
+        client.unload_extension(f'cogs.{argument}')
+        client.load_extension(f'cogs.{argument}')
+    elif command == 'shutdown':
+        await stop()
+
+
+@tasks.loop(seconds=SHARD_POLL_INTERVAL)
+async def poll_shard_commands():
+    """
+    Carries out owner commands issued by other bot processes, and lets the
+    cogs know when those processes changed the database.
+    """
+    global last_command_id
+    await db.poll_external_changes()
+    for command_id, command, argument, origin in \
+            await db.shard_commands_since(last_command_id):
+        last_command_id = command_id
+        if origin == PROCESS_ID:
+            continue
+        try:
+            await run_owner_command(command, argument)
+        except Exception as e:
+            capture_error(e, f'shard command {command}')
+        if client.is_closed():
+            return
+
+
+async def prepare():
+    """ Loads the state kept in the database before connecting. """
+    global last_command_id
+    await settings.load('data/guilds.json')
+    last_command_id = await db.last_shard_command_id()
+
+
+@tasks.loop(seconds=ERROR_SAVE_INTERVAL)
+async def save_errors():
+    """ Writes the errors captured since the last save, off the event loop. """
+    entries = errors.take_unsaved()
+    if entries:
+        await asyncio.get_running_loop().run_in_executor(
+            None, errors.save, entries)
+
+
+async def stop():
+    """ Finishes outstanding work and disconnects this process. """
+    poll_shard_commands.stop()
+    export_metrics.stop()
+    save_errors.stop()
+    for cog in list(client.cogs.values()):
+        close = getattr(cog, 'close', None)
+        if close is not None:
+            await close()
+    await db.close()
+    await asyncio.get_running_loop().run_in_executor(
+        None, errors.save, errors.take_unsaved())
+    await client.change_presence(status=discord.Status.offline)
+    await client.close()
 
 
 @client.event
 async def on_guild_join(guild):
-    with open('data/guilds.json', 'r') as f:
-        guilds = json.load(f)
-    guilds[str(guild.id)]['prefix'] = DEFAULT_PREFIX
-    with open('data/guilds.json', 'w') as f:
-        json.dump(guilds, f, indent=4)
+    await settings.set_prefix(guild.id, DEFAULT_PREFIX)
 
 
 @client.event
 async def on_guild_remove(guild):
-    with open('data/guilds.json', 'r') as f:
-        guilds = json.load(f)
-    guilds.pop(str(guild.id))
-    with open('data/guilds.json', 'w') as f:
-        json.dump(guilds, f, indent=4)
+    await settings.remove(guild.id)
 
 
 @client.command(help='Change bot prefix for this server')
 async def changeprefix(ctx, prefix):
-    with open('data/guilds.json', 'r') as f:
-        guilds = json.load(f)
-    guilds[str(ctx.guild.id)]['prefix'] = prefix
-    with open('data/guilds.json', 'w') as f:
-        json.dump(guilds, f, indent=4)
+    await settings.set_prefix(ctx.guild.id, prefix)
     await ctx.send(f'The prefix has been changed to `{prefix}`!')
 
 
@@ -78,6 +391,7 @@ async def on_member_remove(member):
 @commands.is_owner()
 async def load(ctx, extension):
     client.load_extension(f'cogs.{extension}')
+    await broadcast('load', extension)
     await ctx.send(f'Loaded {extension}!')
 
 
@@ -85,6 +399,7 @@ async def load(ctx, extension):
 @commands.is_owner()
 async def unload(ctx, extension):
     client.unload_extension(f'cogs.{extension}')
+    await broadcast('unload', extension)
     await ctx.send(f'Poof! Unloaded {extension}.')
 
 
@@ -93,28 +408,95 @@ async def unload(ctx, extension):
 async def reload(ctx, extension):
     client.unload_extension(f'cogs.{extension}')
     client.load_extension(f'cogs.{extension}')
+    await broadcast('reload', extension)
     await ctx.send(f'Reloaded {extension}!')
 
 
+@client.command(help='(DEV) Show prefix cache statistics')
+@commands.is_owner()
+async def prefixstats(ctx):
+    await ctx.send(f'Prefix lookups served from memory: {settings.hits} '
+                   f'({settings.misses} defaulted, {settings.writes} writes)')
+
+
+@client.command(help='(DEV) Show the slowest commands and queries')
+@commands.is_owner()
+async def slowest(ctx, n: int = 5):
+    lines = []
+    for kind in ('command', 'query'):
+        lines.append(f'__**Slowest {kind}s**__')
+        for name, histogram in REGISTRY.slowest(kind, n):
+            lines.append(f'`{name}` ⋅ {histogram.count} calls ⋅ '
+                         f'mean {histogram.mean * 1000:.1f} ms ⋅ '
+                         f'max {histogram.max * 1000:.1f} ms')
+    await ctx.send('\n'.join(lines))
+
+
+@client.command(help='(DEV) Show the shards of this process')
+@commands.is_owner()
+async def shards(ctx):
+    if args.shard_count == None:
+        await ctx.send('Running unsharded.')
+        return
+    lines = [f'Process `{PROCESS_ID}` runs {len(args.shard_ids or [])} of '
+             f'{args.shard_count} shards.']
+    for shard_id, shard in sorted(client.shards.items()):
+        lines.append(f'Shard {shard_id} ⋅ {round(shard.latency * 1000)} ms')
+    await ctx.send('\n'.join(lines))
+
+
+@client.command(name='errors', help='(DEV) Show the most frequent errors, '
+                'or the latest traceback of one')
+@commands.is_owner()
+async def show_errors(ctx, fingerprint: str = None):
+    if fingerprint != None:
+        tb = errors.latest_traceback(fingerprint)
+        if tb == None:
+            await ctx.send(f'No recent traceback for `{fingerprint}`.')
+            return
+        text = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: ''.join(tb.format()))
+        await ctx.send(f'```\n{text[-1900:]}```')
+        return
+    groups = errors.top(10)
+    if not groups:
+        await ctx.send('No errors since the bot started.')
+        return
+    now = time.time()
+    lines = [f'__**Most frequent errors**__ ({errors.captured} in total)']
+    for group in groups:
+        ago = round((now - group.last_seen) / 60)
+        lines.append(f'`{group.fingerprint}` ⋅ {group.count}× ⋅ {group.context} '
+                     f'⋅ {group.type}: {group.message[:80]} ⋅ last {ago} min ago')
+    await ctx.send('\n'.join(lines))
+
+
 @client.command(aliases=['exit', 'stop'], help='(DEV) Stop the bot')
 @commands.is_owner()
 async def shutdown(ctx):
     await ctx.send('Turning off, goodbye!')
-    await client.change_presence(status=discord.Status.offline)
-    await ctx.bot.logout()
+    await broadcast('shutdown')
+    await stop()
 
 
 @client.event
 async def on_error(event, *args, **kwargs):
-    with open('err.log', 'a') as f:
-        if event == 'on_message':
-            f.write(f'Unhandled message: {args[0]}\n')
-        else:
-            raise
+    capture_error(sys.exc_info()[1], f'event {event}')
+
+
+@client.event
+async def on_shard_ready(shard_id):
+    print(f'Shard {shard_id} is online!')
 
 
 @client.event
 async def on_ready():
+    if not export_metrics.is_running():
+        export_metrics.start()
+    if not poll_shard_commands.is_running():
+        poll_shard_commands.start()
+    if not save_errors.is_running():
+        save_errors.start()
     await client.change_presence(status=discord.Status.dnd, activity=discord.Game(f'{STATUS}'))
     print(f'{client.user} is online!')
 
@@ -123,4 +505,6 @@ for filename in os.listdir('./cogs'):
     if filename.endswith('.py'):
         client.load_extension(f'cogs.{filename[:-3]}')  # splice removes '.py'
 
+client.loop.run_until_complete(prepare())
 client.run(TOKEN)
+logs.stop()
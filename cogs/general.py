@@ -24,6 +24,7 @@ class General(commands.Cog):
     @clear.error
     async def clear_error(self, ctx, error):
         if isinstance(error, commands.MissingRequiredArgument):
+            ctx.error_handled = True
             await ctx.send("Please specify the number of messages to delete.")
 
     @commands.command(help='Change the status of the bot')
@@ -47,6 +48,7 @@ class General(commands.Cog):
     @changestatus.error
     async def changestatus_error(self, ctx, error):
         if isinstance(error, commands.MissingRequiredArgument):
+            ctx.error_handled = True
             await ctx.send('Missing required argument. Use one of the following: `online`, `idle`, `dnd`, `invis`.')
 
 
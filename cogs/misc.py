@@ -46,6 +46,7 @@ class Misc(commands.Cog):
     @_8ball.error
     async def _8ball_error(self, ctx, error):
         if isinstance(error, commands.MissingRequiredArgument):
+            ctx.error_handled = True
             await ctx.send("Please provide a yes/no question.")
 
     @commands.command(name='io', help='List some web browser games.')
@@ -1,19 +1,37 @@
 # quiz.py
 import discord
 import discord_ui
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-import json
-import random
 import asyncio
-import numpy as np
-import background.database as database
+import background.sessions as sessions
+import background.router as router
+import background.page_cache as page_cache
+import background.leaderboard as leaderboard
+from background.metrics import REGISTRY
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 PROFILE_THUMBNAIL = os.getenv('PROFILE_THUMBNAIL')
 DEFAULT_PRONOUNCE = os.getenv('DEFAULT_PRONOUNCE')
+CATALOG_SNAPSHOT = os.getenv('CATALOG_SNAPSHOT', 'data/catalog.pickle')
+CONTENT_FILE = 'data/levels_aux.json'
+MAX_QUIZ_LENGTH = 20
+# Answers of a multi-question quiz are queued in groups of this size.
+QUIZ_CHECKPOINT = 5
+RACE_TIMEOUT = 15
+# Entries of each dictionary section on a page, which keeps every field
+# well under Discord's limit of 1024 characters.
+DICTIONARY_PAGE_SIZE = 25
+DICTIONARY_TIMEOUT = 60
+LEADERBOARD_SIZE = 10
+# Minutes between consistency checks of the leaderboards against the database
+LEADERBOARD_REBUILD = 10
+
+# Normalized probability distribution of asking a word of each familiarity
+BIN_WEIGHTS = (20, 13, 13, 13, 12, 5, 5, 5, 5, 8)
+BIN_WEIGHTS = tuple(weight / sum(BIN_WEIGHTS) for weight in BIN_WEIGHTS)
 
 
 class Quiz(commands.Cog):
@@ -21,47 +39,148 @@ class Quiz(commands.Cog):
     def __init__(self, client):
         self.client = client
         self.ui = discord_ui.UI(client)
-        self.in_progress = []
-        with open('data/vocabulary.json', 'r', encoding='utf-8') as f:
-            self.vocabulary = json.load(f)
-        with open('data/levels.json', 'r', encoding='utf-8') as f:
-            self.levels = json.load(f)
-        self.db = database.Database()
+        self.sessions = sessions.SessionManager()
+        self.router = router.AnswerRouter()
+        self.races = set()
+        self.db = client.db
+        self.catalog_version = None
+        self.catalog = None
+        # commands wait for the first catalog in cog_before_invoke
+        self.catalog_loading = client.loop.create_task(self.load_catalog())
+        self.dictionary_pages = page_cache.PageCache()
+        self.db.change_listeners.append(self.dictionary_pages.invalidate_user)
+        self.db.external_change_listeners.append(self.on_external_change)
+        self.leaderboards = leaderboard.Leaderboard(self.db, LEADERBOARD_SIZE)
+        self.db.score_listeners.append(self.leaderboards.scores_changed)
+        self.expire_sessions.start()
+        self.rebuild_leaderboards.start()
+
+    def cog_unload(self):
+        self.catalog_loading.cancel()
+        self.expire_sessions.cancel()
+        self.rebuild_leaderboards.cancel()
+        self.db.change_listeners.remove(self.dictionary_pages.invalidate_user)
+        self.db.external_change_listeners.remove(self.on_external_change)
+        self.db.score_listeners.remove(self.leaderboards.scores_changed)
+
+    async def cog_before_invoke(self, ctx):
+        await asyncio.shield(self.catalog_loading)
+
+    def on_external_change(self):
+        """
+        Called when another process, such as another shard or the content
+        compiler, committed to the database.
+        """
+        # other processes do not say whose data they changed
+        self.dictionary_pages.clear()
+        self.leaderboards.invalidate()
+        asyncio.ensure_future(self.refresh_catalog())
+
+    async def load_catalog(self):
+        """
+        Loads the first catalog. An up to date snapshot saves building it
+        from the database.
+        """
+        self.catalog_version = await self.db.catalog_version()
+        self.catalog = await self.db.catalog(CATALOG_SNAPSHOT)
+
+    async def refresh_catalog(self) -> bool:
+        """
+        Reloads the catalog if the vocab or sets changed since it was loaded.
+
+        Returns:
+            bool of whether the catalog was reloaded
+        """
+        await asyncio.shield(self.catalog_loading)
+        version = await self.db.catalog_version()
+        if version == self.catalog_version:
+            return False
+        self.catalog_version = version
+        self.catalog = await self.db.catalog(CATALOG_SNAPSHOT)
+        self.dictionary_pages.clear()
+        return True
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        self.router.route(message)
+
+    @tasks.loop(seconds=30)
+    async def expire_sessions(self):
+        """ Sweeps abandoned quiz sessions. """
+        self.sessions.expire()
+        REGISTRY.set_gauge('quiz_sessions', self.sessions.active)
+
+    @tasks.loop(minutes=LEADERBOARD_REBUILD)
+    async def rebuild_leaderboards(self):
+        """ Checks the incrementally updated leaderboards against the database. """
+        drifted = await self.leaderboards.rebuild()
+        REGISTRY.inc('leaderboard_rebuilds')
+        REGISTRY.set_gauge('leaderboard_drift', drifted)
+
+    async def close(self):
+        """ Commits outstanding database work before the bot stops. """
+        await self.db.flush()
+
+    async def gen_question_data(self, user_id: int, n: int = 1,
+                                review: bool = False):
+        """
+        Loads Q&A pairs based on player level and word familiarity of
+        their active set.
+
+        Arguments:
+            user_id: Discord id of player
+            n: number of questions
+            review: ask the words that are most overdue for review instead of
+                sampling by familiarity
+        Returns:
+            A list of up to n triples in the form of (vocab_id, question_word,
+            answer), or an empty list if the active set has no vocab to ask
+        """
+        if review:
+            return await self.db.due_vocab(user_id, n)
+        if n == 1:
+            question = await self.db.sample_question(user_id, BIN_WEIGHTS)
+            return [] if question is None else [question]
+        return await self.db.sample_deck(user_id, BIN_WEIGHTS, n)
 
     @commands.command(aliases=['q'])
-    async def quiz(self, ctx):
-        """ Asks what a vocabulary word is in romaji. """
-        def gen_question_data(user_id: int, bin_weights: np.array):
-            """
-            Loads a Q&A pair from levels.json based on player level
-            and word familiarity of that specific set.
+    async def quiz(self, ctx, n: int = 1):
+        """
+        Asks what a vocabulary word is in romaji. Give a number to answer
+        several words in a row.
+        """
+        await self.run_quiz(ctx, n)
 
-            Arguments:
-                user_id: Discord id of player
-                bin_weights: Normalized numpy array of size 10 that represents
-                    the probability distribution of each familiarity level
-            Returns:
-                A pair in the form of (vocab_id, question_word, answer)
-            """
-            found = False
-            rng = np.random.default_rng()
-            bin_priority = rng.choice(
-                np.arange(10), size=10, replace=False, p=bin_weights)
-            i = 0
-            while not found and i < 10:
-                bin_index = int(bin_priority[i])
-                bin = self.db.player_vocab(user_id, bin_index)
-                bin_sz = len(bin)
-                if bin_sz > 0:
-                    vocab_id = random.choice(bin)[0]
-                    jp_char, romaji = self.db.as_defn_pair(vocab_id)
-                    found = True
-                else:
-                    i += 1
+    @quiz.error
+    async def quiz_error(self, ctx, error):
+        if isinstance(error, commands.errors.BadArgument):
+            ctx.error_handled = True
+            await ctx.send('Please provide the number of questions to ask.')
 
-            return vocab_id, jp_char, romaji
+    @commands.command(aliases=['rv'])
+    async def review(self, ctx, n: int = 1):
+        """
+        Asks the words of your active set that are due for review, most
+        overdue first. Words you know well come back less often.
+        """
+        await self.run_quiz(ctx, n, review=True)
 
-        async def q_and_a():
+    @review.error
+    async def review_error(self, ctx, error):
+        if isinstance(error, commands.errors.BadArgument):
+            ctx.error_handled = True
+            await ctx.send('Please provide the number of words to review.')
+
+    async def run_quiz(self, ctx, n: int, review: bool = False):
+        """
+        Asks the player n questions in a row and records their answers.
+
+        Arguments:
+            ctx: context of the quiz or review command
+            n: number of questions
+            review: ask the words that are due for review
+        """
+        async def q_and_a(vocab_id: int, jp_char: str, romaji: str):
             """
             Print question and parse player answer.
 
@@ -70,10 +189,7 @@ class Quiz(commands.Cog):
             """
             await ctx.send(f'What is the following character in romaji? \n {jp_char}')
 
-            def check(msg):
-                return ctx.author == msg.author and ctx.channel == msg.channel
-
-            pronunciation = self.db.pronunciation(vocab_id)
+            pronunciation = self.catalog.pronunciation(vocab_id)
             if pronunciation == None:
                 pronunciation = DEFAULT_PRONOUNCE
 
@@ -83,7 +199,7 @@ class Quiz(commands.Cog):
             )
 
             try:
-                msg = await self.client.wait_for("message", timeout=5, check=check)
+                msg = await self.router.wait(ctx.channel.id, ctx.author.id, timeout=5)
             except asyncio.TimeoutError:
                 await self.ui.components.send(
                     channel=ctx.channel,
@@ -100,26 +216,110 @@ class Quiz(commands.Cog):
                         components=[pronounce_btn])
             return False
 
-        if ctx.author.id in self.in_progress:
+        if not 1 <= n <= MAX_QUIZ_LENGTH:
+            await ctx.send(f'Please choose between 1 and {MAX_QUIZ_LENGTH} questions.')
+            return
+
+        session = self.sessions.start(ctx.author.id, ctx.channel.id)
+        if session is None:
             await ctx.send('Please wait until starting a new quiz.')
             return
 
-        self.in_progress.append(ctx.author.id)
+        try:
+            if not await self.db.user_exists(ctx.author.id):
+                await self.db.create_user(ctx.author.id)
+
+            questions = await self.gen_question_data(ctx.author.id, n, review)
+            if len(questions) == 0 and review:
+                due = await self.db.next_review(ctx.author.id)
+                if due != None:
+                    await ctx.send(f'Nothing is due for review. Your next word is due <t:{due}:R>.')
+                    return
+            if len(questions) == 0:
+                await ctx.send('There is nothing to practice in your active set.')
+                return
 
-        if not self.db.user_exists(ctx.author.id):
-            self.db.create_user(ctx.author.id)
+            if ctx.guild is not None:
+                await self.leaderboards.seen(ctx.author.id, ctx.guild.id)
+            answers = []
+            num_correct = 0
+            for vocab_id, jp_char, romaji in questions:
+                session.vocab_id = vocab_id
+                self.sessions.touch(session)
+                correct = await q_and_a(vocab_id, jp_char, romaji)
+                num_correct += correct
+                answers.append((vocab_id, correct))
+                if len(answers) == QUIZ_CHECKPOINT:
+                    await self.db.response_updates(ctx.author.id, answers)
+                    answers = []
+            if answers:
+                await self.db.response_updates(ctx.author.id, answers)
+            if len(questions) > 1:
+                await self.db.flush()
+                await ctx.send(f'You answered {num_correct}/{len(questions)} correctly!')
+
+            new_level, level_up = await self.db.check_level_up(ctx.author.id)
+            if level_up:
+                await ctx.send(f':partying_face: Congratulations! You are now Level {new_level}!')
+        finally:
+            self.sessions.end(session)
 
-        bin_weights = np.array([20, 13, 13, 13, 12, 5, 5, 5, 5, 8])
-        bin_weights = bin_weights / np.sum(bin_weights)
-        vocab_id, jp_char, romaji = gen_question_data(
-            ctx.author.id, bin_weights)
+    @commands.command()
+    async def race(self, ctx):
+        """
+        Asks the whole channel a word from your active set. The first correct
+        answer wins.
+        """
+        if ctx.channel.id in self.races:
+            await ctx.send('A race is already running in this channel.')
+            return
+        self.races.add(ctx.channel.id)
 
-        correct = await q_and_a()
-        self.db.response_update(ctx.author.id, vocab_id, correct)
-        new_level, level_up = self.db.check_level_up(ctx.author.id)
-        if level_up:
-            await ctx.send(f':partying_face: Congratulations! You are now Level {new_level}!')
-        self.in_progress.remove(ctx.author.id)
+        try:
+            if not await self.db.user_exists(ctx.author.id):
+                await self.db.create_user(ctx.author.id)
+            questions = await self.gen_question_data(ctx.author.id)
+            if len(questions) == 0:
+                await ctx.send('There is nothing to practice in your active set.')
+                return
+            vocab_id, jp_char, romaji = questions[0]
+
+            # first answer of each participant, in the order they were given
+            answers = {}
+            won = asyncio.get_running_loop().create_future()
+
+            def on_answer(msg):
+                if msg.author.bot or msg.author.id in answers or won.done():
+                    return
+                correct = msg.content.casefold() == romaji.casefold()
+                answers[msg.author.id] = correct
+                if correct:
+                    won.set_result(msg.author)
+
+            self.router.listen(ctx.channel.id, on_answer)
+            await ctx.send(f':checkered_flag: First to answer wins! What is the following character in romaji? \n {jp_char}')
+            try:
+                winner = await asyncio.wait_for(won, timeout=RACE_TIMEOUT)
+            except asyncio.TimeoutError:
+                winner = None
+            finally:
+                self.router.unlisten(ctx.channel.id)
+
+            if winner is None:
+                await ctx.send(f':hourglass: Time\'s up! The answer is `{romaji}`')
+            else:
+                await ctx.send(f':trophy: {winner.mention} wins! The answer is `{romaji}`')
+
+            if ctx.guild is not None:
+                for user_id in answers:
+                    await self.leaderboards.seen(user_id, ctx.guild.id)
+            updated = await self.db.vocab_updates(vocab_id, answers)
+            for user_id in updated:
+                new_level, level_up = await self.db.check_level_up(user_id)
+                if level_up:
+                    await ctx.send(f':partying_face: Congratulations <@{user_id}>! You are now Level {new_level}!')
+        finally:
+            self.races.discard(ctx.channel.id)
 
     @commands.command()
     async def pronounce(self, ctx, native_char: str):
@@ -127,15 +327,19 @@ class Quiz(commands.Cog):
         Returns the pronunciation of a vocabulary word.
         """
         try:
-            vocab_id = self.db.native_to_vocab_id(native_char)
-            url = self.db.pronunciation(vocab_id)
+            vocab_id = self.catalog.native_to_vocab_id(native_char)
+            url = self.catalog.pronunciation(vocab_id)
+            if url == None:
+                raise KeyError(native_char)
             await ctx.send(url)
         except KeyError:
             await ctx.send(":cry: No pronunciation found. Only kanas are supported.")
 
     @pronounce.error
     async def pronounce_error(self, ctx, error):
-        await ctx.send("Please provide a valid kana.")
+        if isinstance(error, commands.errors.UserInputError):
+            ctx.error_handled = True
+            await ctx.send("Please provide a valid kana.")
 
     @commands.command(aliases=['pr'])
     async def profile(self, ctx, user: commands.MemberConverter = None):
@@ -145,11 +349,14 @@ class Quiz(commands.Cog):
         if user == None:
             user = ctx.author
 
+        stats = await self.db.user_stats(user.id)
+        if stats == None:
+            await ctx.send('This user does not have a profile.')
+            return
+
         color = discord.Color.dark_magenta().value
-        level = self.db.total_level(user.id)
-        num_correct = self.db.total_times_correct(user.id)
-        vocab_discovered = self.db.total_vocab(user.id)
-        times_played = self.db.total_times_played(user.id)
+        level, num_correct, times_played, vocab_discovered = stats
+        accuracy = num_correct / times_played if times_played else 0
 
         profile = discord.Embed(
             color=color,
@@ -165,7 +372,7 @@ class Quiz(commands.Cog):
         profile.add_field(
             name='Times Played', value=times_played, inline=False)
         profile.add_field(
-            name='Accuracy', value=f'{(num_correct/times_played):.1%}', inline=False)
+            name='Accuracy', value=f'{accuracy:.1%}', inline=False)
         profile.add_field(
             name='Vocabulary Discovered', value=f'{vocab_discovered}', inline=False)
         await ctx.send(embed=profile)
@@ -173,82 +380,141 @@ class Quiz(commands.Cog):
     @profile.error
     async def profile_error(self, ctx, error):
         if isinstance(error, commands.errors.MemberNotFound):
+            ctx.error_handled = True
             await ctx.send("Invalid user.")
 
+    @commands.command(aliases=['lb', 'top'])
+    async def leaderboard(self, ctx, scope=None):
+        """
+        Shows the top players of this server. Use `global` to see the top
+        players everywhere.
+        """
+        if scope == 'global' or ctx.guild is None:
+            title = 'Global Leaderboard!'
+            entries = await self.leaderboards.top()
+        else:
+            title = f'{ctx.guild.name} Leaderboard!'
+            entries = await self.leaderboards.top(ctx.guild.id)
+
+        desc = '\n'.join(
+            f'**{rank}.** <@{user_id}> ⋅ Level {level} ⋅ {num_correct} correct'
+            for rank, (user_id, level, num_correct) in enumerate(entries, 1))
+        color = discord.Color.dark_magenta().value
+        embed = discord.Embed(
+            color=color,
+            title=title,
+            description=desc or 'Nobody has played yet.'
+        )
+        embed.set_thumbnail(url=PROFILE_THUMBNAIL)
+        await ctx.send(embed=embed)
+
     @commands.command(aliases=['dict'])
     async def dictionary(self, ctx, *, arg=None):
         """
         Displays the words that you have unlocked so far.
         """
-        def generate_string(user_id, set_id, start, stop):
+        async def generate_page(user_id, set_id, page):
             """
-            Generates a string where each line is in form '{KANA} {ROMAJI}'
-            for a dictionary.
+            Renders a page of the dictionary, where each line is in form
+            '{KANA} {ROMAJI}'. Pages are cached until the user's data changes.
 
             Arguments:
                 user_id: Discord user id
                 set_id: Set to display in dictionary
-                start: starting familiarity bin
-                stop: ending familiarity bin
+                page: zero-based page number
             Returns:
-                Pair of string, integer, where:
-                    the string represents the content of the data or "None" if
-                        empty.
-                    the integer counts the number of entries.
-
+                Tuple of (learning entries, learning count, reviewing entries,
+                reviewing count, number of pages), where the entries are
+                strings or "None" if empty.
             """
-            vocab_lst = self.db.set_to_dict(user_id, set_id, start, stop)
-            str_entries = ""
-            count = len(vocab_lst)
-            for vocab in vocab_lst:
-                native = vocab.char_native
-                romaji = vocab.romanization
-                str_entries += f'\n**{native}** {romaji}'
-            if str_entries == '':
-                str_entries = 'None'
-            return str_entries, count
+            key = (user_id, set_id, page)
+            rendered = self.dictionary_pages.get(key)
+            if rendered is not None:
+                return rendered
+            version = self.dictionary_pages.version(user_id)
+            learning, reviewing = await self.db.dict_page(
+                user_id, set_id, page, DICTIONARY_PAGE_SIZE)
+            sections = []
+            for count, entries in (learning, reviewing):
+                lines = '\n'.join(f'**{native}** {romaji}'
+                                   for native, romaji in entries)
+                sections += [lines or 'None', count]
+            longest = max(learning[0], reviewing[0])
+            num_pages = max(1, -(-longest // DICTIONARY_PAGE_SIZE))
+            rendered = tuple(sections) + (num_pages,)
+            self.dictionary_pages.put(key, rendered, version)
+            return rendered
+
+        def page_embed(rendered, page):
+            learn_entries, learn_count, review_entries, review_count, num_pages = rendered
+            color = discord.Color.dark_magenta().value
+            dict = discord.Embed(
+                color=color,
+                title=f'Your Vocabulary Bank!'
+            )
+            dict.set_author(name=ctx.author.display_name,
+                            icon_url=ctx.author.avatar_url)
+            dict.set_thumbnail(url=PROFILE_THUMBNAIL)
+            dict.add_field(name=f'Learning - {learn_count}',
+                           value=learn_entries, inline=False)
+            dict.add_field(name=f'Reviewing - {review_count}',
+                           value=review_entries, inline=False)
+            dict.set_footer(text=f'Page {page + 1}/{num_pages}')
+            return dict
+
+        def page_buttons(page, num_pages):
+            return [
+                discord_ui.Button(custom_id='prev', label='◀',
+                                  disabled=page == 0),
+                discord_ui.Button(custom_id='next', label='▶',
+                                  disabled=page == num_pages - 1),
+            ]
 
         if arg == None:
-            set_id = self.db.active_set_id(ctx.author.id)
+            set_id = await self.db.active_set_id(ctx.author.id)
         else:
             try:
                 try:
                     set_id = int(arg)
-                    assert self.db.set_exists(set_id)
+                    assert self.catalog.set_exists(set_id)
                 except:
-                    set_id = self.db.set_name_to_id(arg)
+                    set_id = self.catalog.set_name_to_id(arg)
             except:
                 await ctx.send('This set cannot be located. Please double-check your input. \
                     \nUse the `sets` command to view all sets.')
                 return
 
         # check if user unlocked the set
-        if not self.db.set_is_unlocked(ctx.author.id, set_id):
+        if not await self.db.set_is_unlocked(ctx.author.id, set_id):
             await ctx.send('You have not unlocked this set yet. \nUse the `sets` command to view all sets.')
             return
 
-        color = discord.Color.dark_magenta().value
-        dict = discord.Embed(
-            color=color,
-            title=f'Your Vocabulary Bank!'
-        )
-        dict.set_author(name=ctx.author.display_name,
-                        icon_url=ctx.author.avatar_url)
-        dict.set_thumbnail(url=PROFILE_THUMBNAIL)
-
-        learn_entries, learn_count = generate_string(
-            ctx.author.id, set_id, 0, 4)
-        review_entries, review_count = generate_string(
-            ctx.author.id, set_id, 5, 8)
-        # master_entries, master_count = generate_string(
-        #     ctx.author.id, set_id, 9, 9)
-        dict.add_field(name=f'Learning - {learn_count}',
-                       value=learn_entries, inline=False)
-        dict.add_field(name=f'Reviewing - {review_count}',
-                       value=review_entries, inline=False)
-        # dict.add_field(
-        #     name=f'Mastered - {master_count}', value=master_entries, inline=False)
-        await ctx.send(embed=dict)
+        page = 0
+        rendered = await generate_page(ctx.author.id, set_id, page)
+        num_pages = rendered[-1]
+        if num_pages == 1:
+            await ctx.send(embed=page_embed(rendered, page))
+            return
+
+        msg = await self.ui.components.send(
+            channel=ctx.channel, embed=page_embed(rendered, page),
+            components=page_buttons(page, num_pages))
+        while True:
+            try:
+                btn = await msg.wait_for('button', self.client, by=ctx.author,
+                                         timeout=DICTIONARY_TIMEOUT)
+            except asyncio.TimeoutError:
+                await msg.disable_components()
+                return
+            await btn.respond(ninja_mode=True)
+            page += 1 if btn.custom_id == 'next' else -1
+            rendered = await generate_page(ctx.author.id, set_id, page)
+            if page >= rendered[-1]:  # the dictionary shrank
+                page = rendered[-1] - 1
+                rendered = await generate_page(ctx.author.id, set_id, page)
+            num_pages = rendered[-1]
+            await msg.edit(embed=page_embed(rendered, page),
+                           components=page_buttons(page, num_pages))
 
     @commands.command()
     async def sets(self, ctx, user: commands.MemberConverter = None):
@@ -256,8 +522,8 @@ class Quiz(commands.Cog):
         if user == None:
             user = ctx.author
 
-        unlocked_sets, locked_sets = self.db.user_sets(user.id)
-        active_set_id = self.db.active_set_id(user.id)
+        unlocked_sets, locked_sets = await self.db.user_sets(user.id)
+        active_set_id = await self.db.active_set_id(user.id)
         desc = '__**Your Sets**__'
         for set in unlocked_sets:
             desc += f'\n ({set.set_id}) **{set.name}** ⋅ Level {set.current_level}/{set.total_levels}'
@@ -281,8 +547,10 @@ class Quiz(commands.Cog):
     @sets.error
     async def sets_error(self, ctx, error):
         if isinstance(error, commands.errors.MemberNotFound):
+            ctx.error_handled = True
             await ctx.send("Invalid user.")
         if isinstance(error, commands.errors.CommandInvokeError):
+            ctx.error_handled = True
             await ctx.send("This user does not have a profile.")
 
     @commands.command()
@@ -292,29 +560,33 @@ class Quiz(commands.Cog):
         try:
             try:
                 set_id = int(arg)
-                assert self.db.set_exists(set_id)
+                assert self.catalog.set_exists(set_id)
             except:
-                set_id = self.db.set_name_to_id(arg)
+                set_id = self.catalog.set_name_to_id(arg)
         except:
             await ctx.send('This set cannot be located. Please double-check your input. \
                 \nUse the `sets` command to view all sets.')
             return
 
         # check if user unlocked the set already
-        if self.db.set_is_unlocked(ctx.author.id, set_id):
+        if await self.db.set_is_unlocked(ctx.author.id, set_id):
             await ctx.send('You have already unlocked this set. \nUse the `sets` command to view all sets.')
             return
 
         # check if unlock conditions are met, and unlock if so.
-        if set_id == 2 and self.db.current_level(ctx.author.id, 1) >= 10:
-            self.db.unlock_set(ctx.author.id, 2)
-            await ctx.send(f'You have unlocked Katakana Letters!')
+        if set_id == 2 and await self.db.current_level(ctx.author.id, 1) >= 10:
+            # an overlapping unlock may have won since the check above
+            if await self.db.unlock_set(ctx.author.id, 2):
+                await ctx.send(f'You have unlocked Katakana Letters!')
+            else:
+                await ctx.send('You have already unlocked this set. \nUse the `sets` command to view all sets.')
         else:
             await ctx.send(f'The requirements to unlock this set have not been met.')
 
     @unlock.error
     async def unlock_error(self, ctx, error):
         if isinstance(error, commands.errors.MissingRequiredArgument):
+            ctx.error_handled = True
             await ctx.send("Please provide a set number or name to unlock. \
                 \nUse the `sets` command to view all sets.")
 
@@ -325,76 +597,81 @@ class Quiz(commands.Cog):
         try:
             try:
                 set_id = int(arg)
-                assert self.db.set_exists(set_id)
+                assert self.catalog.set_exists(set_id)
             except:
-                set_id = self.db.set_name_to_id(arg)
+                set_id = self.catalog.set_name_to_id(arg)
         except:
             await ctx.send('This set cannot be located. Please double-check your input. \
             \nUse the `sets` command to view all sets.')
             return
 
         # check if user unlocked the set already
-        if self.db.set_is_unlocked(ctx.author.id, set_id):
-            self.db.activate_set(ctx.author.id, set_id)
+        if await self.db.set_is_unlocked(ctx.author.id, set_id):
+            await self.db.activate_set(ctx.author.id, set_id)
             await ctx.send('Update successful.')
 
     @activate.error
     async def activate_error(self, ctx, error):
         if isinstance(error, commands.errors.MissingRequiredArgument):
+            ctx.error_handled = True
             await ctx.send("Please provide a valid set number or name to activate. \
                 \nUse the `sets` command to view all of your sets.")
 
     @commands.command()
     @commands.is_owner()
-    async def updatelvls(self, ctx):
-        """(DEV) Updates levels.json from the data of levels_aux.json"""
-        with open('data/levels_aux.json', 'r', encoding='utf-8') as f:
-            levels = json.load(f)
-        for set, data in levels.items():
-            total_lvls = data['total_lvls']
-            count = 0
-            for i in range(1, total_lvls + 1):
-                lst = []
-                for key, _ in data[str(i)].items():
-                    lst.append(key)
-                count += len(data[str(i)])
-                data[str(i)] = lst
-            data['total_vocab'] = count
-
-            levels[set] = data
-        with open('data/levels.json', 'w', encoding='utf-8') as f:
-            json.dump(levels, f, ensure_ascii=False, indent=4)
-        await ctx.send(f'Update successful!')
+    async def reloadcatalog(self, ctx):
+        """(DEV) Reloads vocab and set data from the database"""
+        self.catalog_version = await self.db.catalog_version()
+        self.catalog = await self.db.catalog(CATALOG_SNAPSHOT)
+        await ctx.send(f'Loaded {len(self.catalog.native_ids)} vocab in '
+                       f'{len(self.catalog.set_names)} sets.')
+
+    @commands.command()
+    @commands.is_owner()
+    async def quizsessions(self, ctx):
+        """(DEV) Shows how many quiz sessions are running"""
+        await ctx.send(f'Active quiz sessions: {self.sessions.active} '
+                       f'({self.sessions.expired_total} expired so far)')
 
     @commands.command()
     @commands.is_owner()
-    async def updatevocab(self, ctx):
+    async def verifystats(self, ctx, fix: bool = False):
+        """(DEV) Rebuilds profile stats and level-up counts from the raw tables and reports drift"""
+        drift = await self.db.rebuild_user_stats(fix)
+        counts = await self.db.rebuild_unfamiliar_counts(fix)
+        if len(drift) == 0 and len(counts) == 0:
+            await ctx.send('All profile stats are consistent.')
+            return
+        lines = [f'{user_id}: {stored} -> {actual}'
+                 for user_id, stored, actual in drift[:20]]
+        lines += [f'{user_id} set {set_id}: {stored} -> {actual} unfamiliar'
+                  for user_id, set_id, stored, actual in counts[:20]]
+        action = 'Fixed' if fix else 'Found'
+        await ctx.send(f'{action} drift for {len(drift)} users and '
+                       f'{len(counts)} unlocked sets:\n' + '\n'.join(lines))
+
+    @commands.command(aliases=['updatelvls', 'updatevocab'])
+    @commands.is_owner()
+    async def updatecontent(self, ctx, mode=None):
         """
-        (DEV) Updates vocabulary.json from the data of levels_aux.json.
-        Pronunciation is retained.
+        (DEV) Applies data/levels_aux.json to the vocab and sets in the
+        database. Pronunciation is retained. Use `dry` to only list changes.
         """
-        with open('data/levels_aux.json', 'r', encoding='utf-8') as f:
-            levels = json.load(f)
-        with open('data/vocabulary.json', 'r', encoding='utf-8') as f:
-            vocabulary = json.load(f)
-        updated_vocab = {}
-        for set, data in levels.items():
-            total_lvls = data['total_lvls']
-            for i in range(1, total_lvls + 1):
-                for kana, romaji in data[str(i)].items():
-                    try:
-                        pronunciation = vocabulary[kana]['pronunciation']
-                    except:
-                        pronunciation = None
-                    updated_vocab[kana] = {
-                        "set": set,
-                        "level": i,
-                        "romaji": romaji,
-                        "pronunciation": pronunciation
-                    }
-        with open('data/vocabulary.json', 'w', encoding='utf-8') as f:
-            json.dump(updated_vocab, f, ensure_ascii=False, indent=4)
-        await ctx.send(f'Creation successful!')
+        try:
+            changes = await self.db.update_content(
+                CONTENT_FILE, dry_run=mode == 'dry')
+        except (OSError, ValueError) as e:
+            await ctx.send(f'Could not read `{CONTENT_FILE}`: {e}')
+            return
+        lines = changes.report()
+        if mode == 'dry' and changes:
+            lines.append('Dry run, nothing was written.')
+        elif changes:
+            await self.refresh_catalog()
+        report = '\n'.join(lines)
+        if len(report) > 2000:
+            report = report[:1997] + '...'
+        await ctx.send(report)
 
 
 def setup(client):